@@ -0,0 +1,94 @@
+"""Moves the calls of the old per patient `chats` documents (one growing `calls` array each)
+to one document per call in `calls`, and builds the patient summaries from them.
+
+Run from app/:   python -m cron_job.migrate_chats_to_calls [--batch-size 100] [--restart]
+
+It can be stopped and run again any time: the last migrated `chats` _id is saved in the
+`migrations` collection after every batch and the next run continues after it. A call that
+was already copied (or saved by the app meanwhile) is only updated, never duplicated.
+The `chats` documents are left as they are.
+
+It can run while the app is up: a summary is only replaced if no call updated it while it
+was being computed (see rebuild_patient_summary). A call that ends in the few milliseconds
+between saving its document and updating the summary can still be counted twice, so run it
+at a quiet time (or run it again later, rebuilding is idempotent).
+"""
+import argparse
+import asyncio
+import logging
+
+from pymongo import UpdateOne
+
+from db.mongo_db import db
+from services.mongodb_service import calls_collection, ensure_call_indexes, rebuild_patient_summary
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_ID = "chats_to_calls"
+
+
+def call_documents(chat: dict) -> list:
+    """UpdateOne for every call in the `calls` array of a `chats` document"""
+    operations = []
+    for index, call in enumerate(chat.get("calls") or []):
+        call = dict(call)
+        # Calls saved without an id get a stable one, so running again finds them
+        call_id = call.pop("call_id", None) or f"{chat['_id']}:{index}"
+        call_time = call.pop("call_time", None) or getattr(chat["_id"], "generation_time", None)
+        operations.append(UpdateOne(
+            {"_id": call_id},
+            {
+                "$set": {"patient_id": chat.get("patient_id"), "carehome_id": chat.get("carehome_id"), "status": "completed", **call},
+                "$setOnInsert": {"call_id": call_id, "call_time": call_time},
+                "$min": {"completed_at": call_time},
+            },
+            upsert=True,
+        ))
+    return operations
+
+
+async def migrate(batch_size: int, restart: bool):
+    await ensure_call_indexes()
+    if restart:
+        await db.migrations.delete_one({"_id": MIGRATION_ID})
+    progress = await db.migrations.find_one({"_id": MIGRATION_ID}) or {}
+    last_id = progress.get("last_id")
+    migrated_chats = progress.get("chats", 0)
+    migrated_calls = progress.get("calls", 0)
+    if last_id is not None:
+        logger.info(f"Continuing after chats document {last_id} ({migrated_chats} documents done)")
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        chats = await db.chats.find(query).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not chats:
+            break
+
+        operations = [operation for chat in chats for operation in call_documents(chat)]
+        if operations:
+            await calls_collection.bulk_write(operations, ordered=False)
+        for patient_id in {chat.get("patient_id") for chat in chats if chat.get("patient_id")}:
+            await rebuild_patient_summary(patient_id)
+
+        last_id = chats[-1]["_id"]
+        migrated_chats += len(chats)
+        migrated_calls += len(operations)
+        await db.migrations.update_one(
+            {"_id": MIGRATION_ID},
+            {"$set": {"last_id": last_id, "chats": migrated_chats, "calls": migrated_calls}},
+            upsert=True,
+        )
+        logger.info(f"Migrated {migrated_chats} chats documents, {migrated_calls} calls")
+
+    await db.migrations.update_one({"_id": MIGRATION_ID}, {"$set": {"done": True}}, upsert=True)
+    logger.info(f"Migration done: {migrated_chats} chats documents, {migrated_calls} calls")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move the calls arrays of `chats` to one document per call")
+    parser.add_argument("--batch-size", type=int, default=100, help="chats documents per batch")
+    parser.add_argument("--restart", action="store_true", help="start again from the first chats document")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(migrate(args.batch_size, args.restart))
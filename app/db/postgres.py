@@ -1,5 +1,8 @@
+from contextlib import contextmanager, asynccontextmanager
+
 from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 
 
@@ -9,13 +12,101 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-engine = create_engine(os.getenv('DATABASE_URL'))
+# Connection pool, size it for (uvicorn workers x pool_size + max_overflow) <= Postgres max_connections
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+engine = create_engine(
+    os.getenv('DATABASE_URL'),
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    # Check connections before using them, dropped ones (Azure idle timeout) are replaced instead of failing the query
+    pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1"),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30")),
+)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+# Async drivers for the sync ones DATABASE_URL uses
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def make_async_url(database_url: str):
+    """DATABASE_URL for the async engine (asyncpg takes ssl= instead of sslmode=)"""
+    url = make_url(database_url)
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+    if url.drivername == "postgresql+asyncpg" and "sslmode" in url.query:
+        url = url.update_query_dict({"ssl": url.query["sslmode"]}).difference_update_query(["sslmode"])
+    return url
+
+
+# Same database and pool settings, for the async routes (ASYNC_DATABASE_URL overrides the derived url)
+async_engine = create_async_engine(
+    os.getenv("ASYNC_DATABASE_URL") or make_async_url(os.getenv('DATABASE_URL')),
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1"),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30")),
+)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+@contextmanager
+def session_scope():
+    """Session for service functions: `with session_scope() as db:`
+    The connection always goes back to the pool when the block ends, uncommitted
+    changes are rolled back if the block raises."""
+    db = SessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def async_session_scope():
+    """Async version of session_scope: `async with async_session_scope() as db:`"""
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
+def get_pool_stats() -> dict:
+    """Connections of this worker's pools: checked out (in use), idle in the pool and overflow"""
+    return {**pool_stats(engine.pool), "async_pool": pool_stats(async_engine.pool)}
+
+
+def pool_stats(pool) -> dict:
+    return {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        # SQLAlchemy counts connections the pool hasn't opened yet as negative overflow
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": MAX_OVERFLOW,
+    }
@@ -7,7 +7,16 @@ from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
 # For routes
-from routes import call, demo_bot, analytics, auth, allow_access, cold_call, phone_call
+from routes import call, demo_bot, analytics, auth, allow_access, cold_call, phone_call, metrics
+
+# For closing the pooled ElevenLabs connections on shutdown
+from services.eleven_lab_services import AsyncElevenLabsService
+
+# For saving the conversations that are still only in memory on shutdown
+from services.Langchain_service import close_chat_memory
+
+# For the post call jobs (left in the spool by the last run too)
+from services.post_call_queue import post_call_queue
 
 
 
@@ -62,6 +71,26 @@ def check_me():
     return {"message":"Working fine v-1"}
 
 
+@app.on_event("startup")
+async def start_post_call_queue():
+    post_call_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_post_call_queue():
+    await post_call_queue.close()
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await AsyncElevenLabsService.close()
+
+
+@app.on_event("shutdown")
+async def save_chat_memory():
+    await close_chat_memory()
+
+
 
 
 app.include_router(call.router, prefix="/api/call", tags=["Talk to Bot"])
@@ -75,6 +104,7 @@ app.include_router(allow_access.router, prefix="/api/allow-access", tags=["Allow
 
 app.include_router(analytics.router, prefix="/api/analytics", tags=["Analytics"])
 app.include_router(cold_call.router, prefix="/api/cold-call", tags=["Cold Call Script"])
+app.include_router(metrics.router, prefix="/api/metrics", tags=["Metrics"])
 
 
 
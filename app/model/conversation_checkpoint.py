@@ -0,0 +1,15 @@
+from sqlalchemy import Column, String, DateTime, LargeBinary
+from db.base import Base
+from datetime import datetime, timezone
+
+
+
+
+class ConversationCheckpoint(Base):
+    """Latest LangGraph checkpoints of a conversation (thread_id = chat id of the call),
+    so any worker can resume the conversation"""
+    __tablename__ = "conversation_checkpoints"
+
+    thread_id = Column(String, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), index=True)
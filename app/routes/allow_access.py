@@ -10,7 +10,7 @@ from services.postgres import grant_access_by_email
 # For sendinf confirmation email to the carehome
 from services.send_email import send_email_alert
 
-from services.postgres import give_access_to_user_by_admin
+from services.postgres import agive_access_to_user_by_admin
 
 from services.send_email import send_email_alert
 
@@ -47,7 +47,7 @@ async def give_access_to_user(email: str):
     Endpoint to give access to user
     """
     try:
-        did_give_access = give_access_to_user_by_admin(email)
+        did_give_access = await agive_access_to_user_by_admin(email)
         # Send email to user to inform that they have access to the bot
         subject = "Your Request for demo bot has been granted"
         body = "Hi please go back to the login"
@@ -6,37 +6,36 @@ from fastapi.responses import JSONResponse
 from fastapi import WebSocket, WebSocketDisconnect
 
 
-import json
 from fastapi import WebSocket, WebSocketDisconnect, Query
 from deepgram import DeepgramClient, LiveTranscriptionEvents, LiveOptions
 
 import os
 from dotenv import load_dotenv
-from services.Langchain_service import chat_with_model, greet_user, invoke_model
+from services.Langchain_service import chat_with_model, greet_user, release_chat_memory
 import logging
 
 # For extracting history
-from services.Langchain_service import get_chat_history
-from services.after_call_ends import change_call_status_to_completed
+from services.Langchain_service import aget_chat_history
+
+# For sentiment, saving the call and the status update after the call ends
+from services.post_call_queue import post_call_queue
+
+# For saving the transcript while the call goes on
+from services.transcript_checkpoints import create_transcript_checkpointer
 
-# for sentiment analysis
-from services.sentiment_analysis import check_sentiment_using_textblob
 
 
 # For Prompt
-from services.preparing_prompt import prepare_prompt
+from services.preparing_prompt import prepare_prompt_from_context
 
 # get-data-before-call
 from services.eleven_lab_services import eleven_labs_voices
-from services.postgres import get_time_from_schedule_call_using_patient_id, get_voice_from_db, get_first_name_of_patient, get_carehome_id_from_patient_id
+from services.postgres import aget_time_from_schedule_call_using_patient_id, aget_cached_patient_context, aget_patient_context, aget_pre_call_data
+from schema.call_bot import PreCallDataBatch
 
-# for db
-from fastapi import Depends
-from sqlalchemy.orm import Session
-from db.postgres import get_db
+# For dropping a patient's cached context when its data changes
+from services.patient_context_cache import patient_context_cache
 
-# For uploading on mongodb
-from services.mongodb_service import upload_chat_history_on_mongodb
 
 
 
@@ -46,10 +45,13 @@ import uuid
 
 
 # For TTS (text to speech)
-from utils.eleven_labs_utils import text_to_speech
+from utils.eleven_labs_utils import atext_to_speech_bytes
+
+# For greeting the patient right away (prepared during get-data-before-call)
+from services.warm_sessions import warm_sessions
 
-# for sending intruptions
-from utils.utils import send_interruption
+# For running LLM + TTS of every turn off the deepgram thread
+from services.turn_pipeline import TurnPipeline
 
 import asyncio
 
@@ -78,21 +80,36 @@ deepgram_client = DeepgramClient(api_key)
 
 # we have this separate endpoint to save time on websocket endpoint
 @router.get("/get-data-before-call")
-def get_call_time(schedule_id: str,patient_id: str, db: Session = Depends(get_db)):
+async def get_call_time(schedule_id: str,patient_id: str):
     """TO get 
         -> Time duration of the cal.
         -> To get patient_id againt a schedule_id (right now we aren't but in future if we need it cuz frontend alredy has patient_id)
         -> Voice_id (of ELevenlabs) which the bot uses for this patient
-        -> User first name with which the bot greets the user"""
+        -> User first name with which the bot greets the user
+        -> session_token: the prompt, greeting and greeting audio start getting ready in the
+           background, pass this token to /call-with-bot so the greeting plays right away"""
     try:
-        call_time = get_time_from_schedule_call_using_patient_id(schedule_id)
-        voice = get_voice_from_db(patient_id)
-        voice_id = eleven_labs_voices.get(voice)
-        patient_first_name = get_first_name_of_patient(patient_id)
-        carehome_id = get_carehome_id_from_patient_id(patient_id)
+        # Patient, summary, life history and active scheduled call in one query, the warm up reuses it for the prompt
+        context = await aget_cached_patient_context(patient_id)
+        if context is not None and context.schedule_id != schedule_id:
+            # Calls are scheduled outside this service, the cached scheduled call (title and
+            # description of the prompt) may be an old one
+            await patient_context_cache.ainvalidate(patient_id)
+            context = await aget_patient_context(patient_id)
+            await patient_context_cache.aput(patient_id, context)
+        if context is None:
+            raise HTTPException(status_code=404, detail="User with this user id not found")
+        if context.schedule_id == schedule_id and context.call_duration:
+            call_time = context.call_duration
+        else:
+            call_time = await aget_time_from_schedule_call_using_patient_id(schedule_id)
+        voice_id = eleven_labs_voices.get(context.voice)
+        patient_first_name = context.first_name
+        carehome_id = context.carehome_id
         
+        session_token = warm_sessions.start(patient_id, patient_first_name, voice_id, context, schedule_id)
         
-        return JSONResponse(content={"call_time": call_time, "voice_id": voice_id, "patient_first_name": patient_first_name, "carehome_id": carehome_id}, status_code=200)
+        return JSONResponse(content={"call_time": call_time, "voice_id": voice_id, "patient_first_name": patient_first_name, "carehome_id": carehome_id, "session_token": session_token}, status_code=200)
     
         
     except HTTPException as he: 
@@ -105,6 +122,58 @@ def get_call_time(schedule_id: str,patient_id: str, db: Session = Depends(get_db
     
 
 
+@router.post("/get-data-before-calls")
+async def get_data_before_calls(request: PreCallDataBatch):
+    """get-data-before-call for many calls at once (e.g. a care home dashboard opening the day's
+    schedule), either the given schedule_ids or the calls of carehome_id between start and end.
+    Returns call_time, voice_id, patient_first_name and carehome_id of every call, no session_token:
+    warming up is left to get-data-before-call right before each call"""
+    try:
+        calls = await aget_pre_call_data(request.schedule_ids, request.carehome_id, request.start, request.end)
+        data = [
+            {
+                "schedule_id": call["schedule_id"],
+                "patient_id": call["patient_id"],
+                "scheduled_at": call["call_time"].isoformat() if call["call_time"] else None,
+                "status": call["status"],
+                "call_time": call["call_duration"],
+                "voice_id": eleven_labs_voices.get(call["voice"]),
+                "patient_first_name": call["patient_first_name"],
+                "carehome_id": call["carehome_id"],
+            }
+            for call in calls
+        ]
+        not_found = []
+        if request.schedule_ids is not None:
+            found = {call["schedule_id"] for call in calls}
+            not_found = [schedule_id for schedule_id in request.schedule_ids if schedule_id not in found]
+
+        return JSONResponse(content={"status": True, "data": data, "not_found": not_found}, status_code=200)
+
+    except HTTPException as he:
+        raise he
+
+    except Exception as e:
+        logger.exception(f"Error in get_data_before_calls in routes/call.py -> {str(e)}")
+        return JSONResponse(content={"details": "Error occured"}, status_code=500)
+
+
+
+
+@router.delete("/patient-context/{patient_id}")
+def invalidate_patient_context(patient_id: str):
+    """To be called by whatever changes a patient's details, summary, life history or
+    scheduled calls, so the next call doesn't use the cached ones"""
+    try:
+        patient_context_cache.invalidate(patient_id)
+        return JSONResponse(content={"status": True}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in invalidate_patient_context in routes/call.py -> {str(e)}")
+        return JSONResponse(content={"details": "Error occured"}, status_code=500)
+
+
+
+
 @router.websocket("/call-with-bot")
 async def call_with_bot(websocket: WebSocket):
     await websocket.accept()
@@ -113,43 +182,82 @@ async def call_with_bot(websocket: WebSocket):
     patient_id = params.get("patient_id")
     voice_id = params.get("voice_id")
     carehome_id = params.get("carehome_id")
+    # Token from /get-data-before-call, if the session is warm the greeting is already synthesized
+    session_token = params.get("session_token")
+    # Frontend sends stream=true when it can play a reply that comes in multiple pieces
+    streaming = params.get("stream", "false").lower() in ("true", "1")
+    # audio_format=binary -> audio as binary frames instead of base64 in JSON (see utils/audio_frames.py)
+    binary_audio = params.get("audio_format", "json").lower() == "binary"
+    # Id of the call, generated by the frontend. Reconnecting with the same one resumes the conversation
+    call_id = params.get("call_id")
+    # Scheduled call to mark completed after the call, defaults to the one the session was prepared for
+    schedule_id = params.get("schedule_id")
     logger.info("call started connection opened")
 
+    dg_connection = None
+    send_task = None
+    pipeline = None
+    checkpointer = None
+
     try:
         
-        prompt = prepare_prompt(patient_id)
+        warm_session = await warm_sessions.claim(session_token, patient_id) if session_token else None
+        if warm_session is not None:
+            prompt = warm_session.prompt
+            schedule_id = schedule_id or warm_session.schedule_id
+        else:
+            context = await aget_cached_patient_context(patient_id)
+            prompt = prepare_prompt_from_context(context)
+            if context is not None:
+                schedule_id = schedule_id or context.schedule_id
 
         
         send_task = None
         chat_history = [] 
         
         new_chat_id = uuid.uuid1()
+        if call_id:
+            try:
+                new_chat_id = uuid.UUID(call_id)
+                # Turns from before the reconnect (empty if it's a new call)
+                chat_history = [{"user_query": pair["user_query"], "bot": pair["ai_response"]} for pair in await aget_chat_history(chat_with_model, new_chat_id)]
+            except ValueError:
+                logger.warning(f"Invalid call_id {call_id}, starting a new conversation")
         
         dg_connection = deepgram_client.listen.websocket.v("1")
 
         message_queue = asyncio.Queue()
         
         
-        greetings  = await greet_user(patient_name)
-        audio = text_to_speech(greetings.content, voice_id)
+        if warm_session is not None:
+            audio = warm_session.greeting_audio
+        else:
+            greetings  = await greet_user(patient_name)
+            audio = await atext_to_speech_bytes(greetings.content, voice_id)
         
-        # Send audio as base64 string in JSON
-        message = json.dumps({"audio": audio, "complete": True})
-        message_queue.put_nowait(message)
+        # LLM + TTS for every turn runs on the event loop, deepgram thread only hands over the sentence
+        checkpointer = create_transcript_checkpointer(new_chat_id, patient_id, carehome_id, chat_history)
+        pipeline = TurnPipeline(websocket, message_queue, new_chat_id, prompt, voice_id, chat_history, streaming=streaming, binary=binary_audio,
+                                on_turn=checkpointer.turn_added if checkpointer is not None else None)
+
+        # Confirm binary audio to the frontend before any audio goes out
+        if pipeline.binary:
+            message_queue.put_nowait((None, pipeline.audio_format_message()))
+
+        # Greeting goes out as turn 0, so it gets dropped too if the user talks over it
+        pipeline.send_audio(audio, True)
         
         
-        loop = asyncio.get_event_loop()
 
         def on_message(self, result, **kwargs):
             sentence = result.channel.alternatives[0].transcript
-            if result.speech_final and sentence.strip():
-                asyncio.run_coroutine_threadsafe(send_interruption(websocket), loop)
-                llm_response = invoke_model(sentence,new_chat_id, prompt)  
-                audio = text_to_speech(llm_response, voice_id)
-                chat_history.append({"user_query": sentence, "bot": llm_response}) 
-                # Send audio as base64 string in JSON
-                message = json.dumps({"audio": audio, "complete": True})
-                message_queue.put_nowait(message)
+            if not sentence.strip():
+                return
+            if result.speech_final:
+                pipeline.submit(sentence)
+            else:
+                # User started talking over the bot (interim result)
+                pipeline.on_speech()
 
                 
 
@@ -182,10 +290,17 @@ async def call_with_bot(websocket: WebSocket):
 
         async def send_messages():
             while True:
-                message = await message_queue.get()
-                await websocket.send_text(message)
+                turn_id, message = await message_queue.get()
+                # Skip audio of turns the user has interrupted
+                if pipeline.is_stale(turn_id):
+                    continue
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
 
         send_task = asyncio.create_task(send_messages())
+        pipeline.start()
 
         while True:
             try:
@@ -198,13 +313,23 @@ async def call_with_bot(websocket: WebSocket):
                 logger.exception(f"Error on websocket is: {str(e)}")
                 
                 
-                # chat_history = get_chat_history(chat_with_model,str(new_chat_id))
-                print("Chat history is: ",chat_history)
-                sentiment = check_sentiment_using_textblob(chat_history)
-                did_upload = await upload_chat_history_on_mongodb(patient_id, new_chat_id, chat_history, carehome_id, sentiment)
-                did_change = change_call_status_to_completed(patient_id)
-                if did_change:
-                    logger.info("Call status changed to completed")
+                # chat_history = await aget_chat_history(chat_with_model,str(new_chat_id))
+                # No turn can be added to chat_history after this
+                await pipeline.aclose()
+                # The post call job only adds the turns not checkpointed yet and marks the call completed
+                if checkpointer is not None:
+                    await checkpointer.close()
+                # Sentiment, saving on mongodb, status and safety checks run in the post call queue
+                await post_call_queue.enqueue(new_chat_id, {
+                    "call_id": str(new_chat_id),
+                    "patient_id": patient_id,
+                    "carehome_id": carehome_id,
+                    "schedule_id": schedule_id,
+                    "chat_history": list(chat_history),
+                    # Where the turns not saved yet start, in chat_history and in the saved conversation
+                    "unsaved_from": checkpointer.unsaved_from if checkpointer is not None else 0,
+                    "stored_turns": checkpointer.stored_turns if checkpointer is not None else 0,
+                })
                 break
 
     except Exception as e:
@@ -214,6 +339,11 @@ async def call_with_bot(websocket: WebSocket):
             dg_connection.finish()
         if send_task is not None:
             send_task.cancel()
+        if pipeline is not None:
+            pipeline.stop()
+            release_chat_memory(pipeline.chat_id)
+        if checkpointer is not None:
+            await checkpointer.close()
     try:
         await websocket.close()
     except RuntimeError:
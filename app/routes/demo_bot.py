@@ -12,7 +12,7 @@ from deepgram import DeepgramClient, LiveTranscriptionEvents, LiveOptions
 
 import os
 from dotenv import load_dotenv
-from services.Langchain_service import chat_with_model, greet_user, invoke_model
+from services.Langchain_service import chat_with_model, greet_user, release_chat_memory
 import logging
 
 
@@ -25,13 +25,13 @@ import uuid
 
 
 # For TTS (text to speech)
-from utils.eleven_labs_utils import text_to_speech
+from utils.eleven_labs_utils import atext_to_speech_bytes
 
-# for sending intruptions
-from utils.utils import send_interruption
+# For running LLM + TTS of every turn off the deepgram thread
+from services.turn_pipeline import TurnPipeline
 
 # To check eligibility for if user has used the bot for more than 30 mins
-from services.postgres import is_user_eligible_for_call
+from services.postgres import ais_user_eligible_for_call
 
 from db.dummy_data import PROMPTS
 
@@ -93,17 +93,19 @@ async def call_with_bot(
     email: str = Query(...),
     prompt: str = Query(...),
     voice_id: str = Query(...),
+    stream: bool = Query(False),
+    audio_format: str = Query("json"),
 ):
 
     await websocket.accept()
     dg_connection = None 
     send_task = None 
+    pipeline = None
 
     try:
-        db_gen = get_db()
-        db = next(db_gen)
         full_prompt = PROMPTS.get(prompt)
-        user_eligibility, remaining_time = is_user_eligible_for_call(db, email)
+        # Connection goes back to the pool right after the check, not at the end of the call
+        user_eligibility, remaining_time = await ais_user_eligible_for_call(email)
         if user_eligibility == False:
             await websocket.send_text(json.dumps({"error": "Connection closed"}))
             await websocket.close()
@@ -119,24 +121,29 @@ async def call_with_bot(
 
         message_queue = asyncio.Queue()
 
-        audio = text_to_speech("Hello how are you doing", voice_id)
+        audio = await atext_to_speech_bytes("Hello how are you doing", voice_id)
         
-        # Send audio as base64 string in JSON
-        message = json.dumps({"audio": audio, "complete": True})
-        message_queue.put_nowait(message)
+        # LLM + TTS for every turn runs on the event loop, deepgram thread only hands over the sentence
+        pipeline = TurnPipeline(websocket, message_queue, new_chat_id, full_prompt, voice_id, streaming=stream, binary=(audio_format == "binary"))
+
+        # Confirm binary audio to the frontend before any audio goes out
+        if pipeline.binary:
+            message_queue.put_nowait((None, pipeline.audio_format_message()))
+
+        # Greeting goes out as turn 0, so it gets dropped too if the user talks over it
+        pipeline.send_audio(audio, True)
         
         
-        loop = asyncio.get_event_loop()
 
         def on_message(self, result, **kwargs):
             sentence = result.channel.alternatives[0].transcript
-            if result.speech_final and sentence.strip():
-                asyncio.run_coroutine_threadsafe(send_interruption(websocket), loop)
-                llm_response = invoke_model(sentence,new_chat_id,full_prompt)  
-                audio = text_to_speech(llm_response, voice_id)
-                # Send audio as base64 string in JSON
-                message = json.dumps({"audio": audio, "complete": True})
-                message_queue.put_nowait(message)
+            if not sentence.strip():
+                return
+            if result.speech_final:
+                pipeline.submit(sentence)
+            else:
+                # User started talking over the bot (interim result)
+                pipeline.on_speech()
 
                 
 
@@ -165,10 +172,17 @@ async def call_with_bot(
 
         async def send_messages():
             while True:
-                message = await message_queue.get()
-                await websocket.send_text(message)
+                turn_id, message = await message_queue.get()
+                # Skip audio of turns the user has interrupted
+                if pipeline.is_stale(turn_id):
+                    continue
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
 
         send_task = asyncio.create_task(send_messages())
+        pipeline.start()
 
         while True:
             try:
@@ -186,14 +200,13 @@ async def call_with_bot(
         # Send the error message to the WebSocket client
         await websocket.send_text(json.dumps({"error": str(e)}))
     finally:
-        try:
-            next(db_gen)  
-        except StopIteration:
-            pass
         if dg_connection is not None:
             dg_connection.finish()
         if send_task is not None:
             send_task.cancel()
+        if pipeline is not None:
+            pipeline.stop()
+            release_chat_memory(pipeline.chat_id)
     try:
         await websocket.close()
     except RuntimeError:
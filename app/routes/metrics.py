@@ -0,0 +1,118 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+# For TTS cache hit/miss counters
+from services.tts_cache import tts_cache
+
+# For size of the chat memory and LLM provider latencies
+from services.Langchain_service import memory, model, summarizer
+
+# For compiled prompt cache counters
+from services.prompt_cache import prompt_cache
+
+# For LLM response cache hit rate
+from services.response_cache import response_cache
+
+# For patient context cache hit rate
+from services.patient_context_cache import patient_context_cache
+
+# For Postgres connection pool usage
+from db.postgres import get_pool_stats
+
+# For the post call job backlog
+from services.post_call_queue import post_call_queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+@router.get("/tts-cache")
+def get_tts_cache_stats():
+    """Hit/miss counters and size of the text to speech audio cache"""
+    try:
+        return JSONResponse(content={"status": True, "data": tts_cache.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_tts_cache_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/conversation-memory")
+def get_conversation_memory_stats():
+    """Number of conversations and bytes held by the LangGraph chat memory"""
+    try:
+        return JSONResponse(content={"status": True, "data": memory.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_conversation_memory_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/conversation-summary")
+def get_conversation_summary_stats():
+    """Background summaries of long calls: running, done and failed"""
+    try:
+        return JSONResponse(content={"status": True, "data": summarizer.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_conversation_summary_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/prompt-cache")
+def get_prompt_cache_stats():
+    """Hit/miss counters of the compiled system prompt cache"""
+    try:
+        return JSONResponse(content={"status": True, "data": prompt_cache.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_prompt_cache_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/llm-providers")
+def get_llm_provider_stats():
+    """Rolling p50/p95 time to first token, health and hedge counters of every LLM provider"""
+    try:
+        return JSONResponse(content={"status": True, "data": model.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_llm_provider_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/response-cache")
+def get_response_cache_stats():
+    """Hit rate of the cached replies to short repetitive utterances, per intent"""
+    try:
+        return JSONResponse(content={"status": True, "data": response_cache.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_response_cache_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/patient-context-cache")
+def get_patient_context_cache_stats():
+    """Hit/miss counters and size of the patient context cache"""
+    try:
+        return JSONResponse(content={"status": True, "data": patient_context_cache.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_patient_context_cache_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/db-pool")
+def get_db_pool_stats():
+    """Postgres connections of this worker: checked out, idle and overflow"""
+    try:
+        return JSONResponse(content={"status": True, "data": get_pool_stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_db_pool_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
+
+
+@router.get("/post-call-queue")
+def get_post_call_queue_stats():
+    """Post call jobs in the spool by status, and this worker's processed/retried/failed counters"""
+    try:
+        return JSONResponse(content={"status": True, "data": post_call_queue.stats()}, status_code=200)
+    except Exception as e:
+        logger.exception(f"Error in get_post_call_queue_stats in routes/metrics.py -> {str(e)}")
+        return JSONResponse(content={"status": False, "detail": "An unexpected error occurred"}, status_code=500)
@@ -1,4 +1,4 @@
-from fastapi import FastAPI,Depends, HTTPException, APIRouter
+from fastapi import FastAPI, HTTPException, APIRouter
 
 import asyncio
 
@@ -11,12 +11,9 @@ import json
 import base64
 import logging
 
-from sqlalchemy.orm import Session
-
 
 # Postgres
-from db.postgres import get_db
-from services.postgres import get_patient_id_from_schedule_id, get_patient_phone_number
+from services.postgres import aget_patient_id_from_schedule_id, aget_patient_phone_number
 
 
 router = APIRouter()
@@ -125,24 +122,24 @@ async def run_conversation(client, call_id):
 
 
 @router.post("/call-user")
-async def call_user(schedule_id: str, db: Session = Depends(get_db)):
+async def call_user(schedule_id: str):
     try:
         print("creating task while schdule id is: ",schedule_id)
-        asyncio.create_task(start_call_flow(schedule_id, db))
+        asyncio.create_task(start_call_flow(schedule_id))
         return {"status": "call started"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to start call task: {str(e)}")
 
 
-async def start_call_flow(schedule_id, db):
+async def start_call_flow(schedule_id):
     try:
         
-        patient_id = get_patient_id_from_schedule_id(db, schedule_id)
+        patient_id = await aget_patient_id_from_schedule_id(schedule_id)
         
         if not patient_id:
             raise HTTPException(status_code=404, detail="Patient not found")
         
-        phone_number = get_patient_phone_number(db, patient_id)
+        phone_number = await aget_patient_phone_number(patient_id)
         print("Phone number is: ",phone_number)
         
         server_uri = "wss://ats-demo.call-matrix.com:6061"
@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional
+from datetime import datetime
 class SDPRequest(BaseModel):
     sdp_offer: str
     patient_id: str
@@ -19,4 +21,22 @@ class CallEndDemo(BaseModel):
 
 
 class TelephonicCall(BaseModel):
-    schedule_id: str
\ No newline at end of file
+    schedule_id: str
+
+
+
+class PreCallDataBatch(BaseModel):
+    """Either `schedule_ids`, or a `carehome_id` with the calls scheduled between `start` and `end`
+    (the current UTC day if they are left out)"""
+    schedule_ids: Optional[List[str]] = Field(default=None, max_length=500)
+    carehome_id: Optional[str] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+    @model_validator(mode="after")
+    def check_selection(self):
+        if (self.schedule_ids is None) == (self.carehome_id is None):
+            raise ValueError("Send either schedule_ids or carehome_id")
+        if self.start and self.end and self.start >= self.end:
+            raise ValueError("start has to be before end")
+        return self
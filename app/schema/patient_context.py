@@ -0,0 +1,18 @@
+from pydantic import BaseModel
+from typing import Optional, Union
+
+
+class PatientContext(BaseModel):
+    """Everything about a patient a call needs, loaded with one query (see services/postgres.py -> get_patient_context)"""
+    patient_id: str
+    first_name: Optional[str] = None
+    carehome_id: Optional[str] = None
+    voice: Optional[str] = None
+    medical_summary: Optional[str] = None
+    # False if the family hasn't added a life history (what get_patient_life_history returns)
+    life_history: Union[str, bool, None] = False
+    # Active scheduled call, " " if there is none (what get_current_call_title_description returns)
+    schedule_id: Optional[str] = None
+    call_duration: Optional[int] = None
+    title: Optional[str] = " "
+    description: Optional[str] = " "
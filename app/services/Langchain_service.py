@@ -2,7 +2,7 @@ from langchain_groq import ChatGroq
 
 import os
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 from dotenv import load_dotenv
 # For memory
@@ -11,6 +11,9 @@ from langgraph.graph import START, MessagesState, StateGraph
 
 load_dotenv()
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 user_info ="Pete Hillman , a 78-year-old retired postmaster from Bristol, UK, who is living with early-stage dementia in a care home. Pete has two sons name 'jake' and 'jack' and a daughter name 'margurete'. Pete like to listen to colbie caillat. "
 
@@ -58,77 +61,237 @@ Start warmly, end reassuringly. Keep responses natural and focused on verified i
 
 
 
-from langgraph.checkpoint.memory import MemorySaver
+# Bounded chat memory (max conversations + idle TTL) instead of a MemorySaver that keeps everything
+from services.conversation_memory import create_checkpointer, PersistentMemorySaver
+
+# For keeping the context of long calls in a running summary
+from services.conversation_summary import create_summarizer
 
 
 # langchain_essentials.py
 
-from langchain.chat_models import init_chat_model
+from services.llm_router import create_llm_router
 from langchain.schema import BaseMessage
+from langchain_core.messages import message_chunk_to_message
+from langchain_core.runnables import RunnableLambda
 from typing import TypedDict, List
+import asyncio
+
+
+# For answering short repetitive utterances without the LLM
+from services.response_cache import response_cache
+
+# For picking as much history as fits in the prompt token budget
+from utils.token_budget import select_history
+
+# Max tokens of system prompt + history sent to the LLM on every turn (per deployment)
+PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "3000"))
 
 
 class ChatState(TypedDict):
     input: str
+    # Patient prompt, stored once per conversation (thread) and not repeated in messages
+    system_prompt: str
+    # Only the turns of the conversation (human and AI messages)
     messages: List[BaseMessage]
+    # Running summary of messages[:summarized_count], written in the background by the summarizer
+    summary: str
+    summarized_count: int
 
 
-model = init_chat_model("gpt-3.5-turbo-0125", model_provider="openai")
-# model = init_chat_model("llama3-8b-8192", model_provider="groq")
-# model = init_chat_model("claude-3-5-sonnet-latest", model_provider="anthropic")
+# Routes every request to the fastest healthy provider from LLM_PROVIDERS and hedges slow ones
+# e.g. LLM_PROVIDERS="openai:gpt-3.5-turbo-0125,groq:llama3-8b-8192,anthropic:claude-3-5-sonnet-latest"
+model = create_llm_router()
 
 
 
 def generate_chat_prompt(state: ChatState, config):
-    tpl: ChatPromptTemplate = config["configurable"]["prompt_template"]
-    user_msg = tpl.format_messages(user_input=state["input"])
-    
-    # Append prompt messages to history
-    messages = state.get("messages", []) + user_msg
-    return {"input": state["input"], "messages": messages}
+    # Append only the user's message to history
+    messages = state.get("messages", []) + [HumanMessage(state["input"])]
+    update = {"input": state["input"], "messages": messages}
+
+    # System prompt is rendered on the first turn only
+    if not state.get("system_prompt"):
+        update["system_prompt"] = render_system_prompt(config["configurable"]["prompt_template"], state["input"])
+    return update
+
+
+def build_model_input(state: ChatState) -> list:
+    """What the LLM gets: the system prompt, the summary of the older turns (if any) and
+    as many of the turns after the summary as fit in PROMPT_TOKEN_BUDGET"""
+    summary = state.get("summary", "")
+    messages = state.get("messages", [])[state.get("summarized_count", 0):]
+    history = select_history(state["system_prompt"] + summary, messages, PROMPT_TOKEN_BUDGET)
+    model_input = [SystemMessage(state["system_prompt"])]
+    if summary:
+        model_input.append(SystemMessage(f"Summary of the conversation so far: {summary}"))
+    return model_input + history
+
+
+def is_first_turn(state: ChatState) -> bool:
+    """Only the reply to the first utterance of a conversation goes in the response cache: it
+    is generated from the system prompt and the utterance alone, later replies depend on the
+    conversation and can't be replayed in another one"""
+    return len(state.get("messages", [])) == 1 and not state.get("summary")
 
 def call_model(state: ChatState, config):
     messages = state.get("messages", [])
-    response = model.invoke(messages[-5:]) 
-    messages.append(response)
-    return {"input": state["input"], "messages": messages}
+    # Short repetitive utterances ("hello", "who are you?") may already have a reply for this patient
+    intent = response_cache.intent_of(state["input"])
+    cached = response_cache.get(state["system_prompt"], intent)
+    if cached is not None:
+        response = AIMessage(cached)
+    else:
+        response = model.invoke(build_model_input(state)) 
+        if is_first_turn(state):
+            response_cache.put(state["system_prompt"], intent, response.content)
+    return {"input": state["input"], "messages": messages + [response]}
+
+
+async def acall_model(state: ChatState, config):
+    """Async version of call_model. If the caller passed an `on_token` callback in the
+    configurable, the reply is streamed from the LLM and every token is handed to it."""
+    messages = state.get("messages", [])
+    on_token = config["configurable"].get("on_token")
+    intent = await response_cache.aintent_of(state["input"])
+    cached = response_cache.get(state["system_prompt"], intent)
+    if cached is not None:
+        response = AIMessage(cached)
+        if on_token is not None:
+            on_token(cached)
+    elif on_token is None:
+        response = await model.ainvoke(build_model_input(state))
+    else:
+        full_chunk = None
+        async for chunk in model.astream(build_model_input(state)):
+            if chunk.content:
+                on_token(chunk.content)
+            full_chunk = chunk if full_chunk is None else full_chunk + chunk
+        response = message_chunk_to_message(full_chunk)
+    if cached is None and is_first_turn(state):
+        response_cache.put(state["system_prompt"], intent, response.content)
+    return {"input": state["input"], "messages": messages + [response]}
 
 
 workflow = StateGraph(state_schema=ChatState)
 workflow.add_node("chat_prompt", generate_chat_prompt)
-workflow.add_node("model", call_model)
+workflow.add_node("model", RunnableLambda(call_model, afunc=acall_model))
 workflow.add_edge(START, "chat_prompt")
 workflow.add_edge("chat_prompt", "model")
 
-memory = MemorySaver()
+memory = create_checkpointer()
 chat_with_model = workflow.compile(checkpointer=memory)
 
+# Summarizes turns that fall out of the prompt window, in the background between turns
+summarizer = create_summarizer(chat_with_model, model, PROMPT_TOKEN_BUDGET)
 
 
+def release_chat_memory(chat_id):
+    """Drop the conversation from memory once the call has ended
+    (with a shared CHAT_MEMORY_BACKEND it stays in the store and can still be resumed)"""
+    summarizer.release(chat_id)
+    memory.delete_thread(str(chat_id))
 
 
+async def close_chat_memory():
+    """Writes conversations that weren't saved to the shared store yet, called on shutdown"""
+    if isinstance(memory, PersistentMemorySaver):
+        await memory.aclose()
 
 
-from langchain.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
-def invoke_model(user_text: str, chat_id: str, prompt_template: str):
-    # Build prompt template dynamically
-    dynamic_tpl = ChatPromptTemplate.from_messages([
-        SystemMessagePromptTemplate.from_template(prompt_template),
-        HumanMessagePromptTemplate.from_template("{user_input}")
-    ])
 
-    input_data = {"input": user_text}
-    config = {
+
+
+
+
+# Compiled system prompts, cached by prompt text
+from services.prompt_cache import prompt_cache, render_system_prompt
+
+def build_model_config(chat_id: str, prompt_template: str) -> dict:
+    return {
         "configurable": {
-            "thread_id": chat_id,
-            "prompt_template": dynamic_tpl
+            "thread_id": str(chat_id),
+            # Pre-rendered SystemMessage or compiled template, parsed once per prompt text
+            "prompt_template": prompt_cache.get(prompt_template)
         }
     }
 
+
+# The async functions (ainvoke_model, astream_model, greet_user, aget_chat_history) are the
+# ones to use from routes: they never block the event loop, so every call on the worker can
+# wait on the LLM at the same time. The sync ones are only for code that runs outside the loop.
+
+async def run_turn(chat_id: str, input_data: dict, config: dict) -> dict:
+    # The summarizer can't write the summary while a turn of this conversation is running
+    async with summarizer.lock(chat_id):
+        result = await chat_with_model.ainvoke(input_data, config=config)
+    summarizer.schedule(chat_id)
+    return result
+
+
+async def ainvoke_model(user_text: str, chat_id: str, prompt_template: str):
+    """Runs one turn of the conversation and returns the reply text.
+    Cancelling it also cancels the request to the LLM"""
+    input_data = {"input": user_text}
+    config = build_model_config(chat_id, prompt_template)
+
+    result = await run_turn(chat_id, input_data, config)
+    return result["messages"][-1].content
+
+
+def invoke_model(user_text: str, chat_id: str, prompt_template: str):
+    """Blocking version of ainvoke_model, don't call it from async code.
+    It doesn't update the running summary (the summarizer runs on the event loop)"""
+    input_data = {"input": user_text}
+    config = build_model_config(chat_id, prompt_template)
+
     result = chat_with_model.invoke(input_data, config=config)
     return result["messages"][-1].content
 
 
+async def astream_model(user_text: str, chat_id: str, prompt_template: str):
+    """Same turn as ainvoke_model but yields the reply token by token as the LLM produces it.
+    The turn is saved in the chat memory once the whole reply has been generated."""
+    tokens = asyncio.Queue()
+    input_data = {"input": user_text}
+    config = build_model_config(chat_id, prompt_template)
+    config["configurable"]["on_token"] = tokens.put_nowait
+
+    run = asyncio.create_task(run_turn(chat_id, input_data, config))
+    # None marks the end of the reply (or an error, which `await run` raises below)
+    run.add_done_callback(lambda _: tokens.put_nowait(None))
+    try:
+        while True:
+            token = await tokens.get()
+            if token is None:
+                break
+            yield token
+        await run
+    finally:
+        if not run.done():
+            run.cancel()
+
+
+async def atrim_interrupted_reply(chat_id: str, user_text: str, said: str):
+    """After a barge-in, keeps only the part of the reply the patient heard (`said`, "" if
+    nothing was played) in the chat memory, so the next turns don't assume the rest was said"""
+    config = {"configurable": {"thread_id": str(chat_id)}}
+    try:
+        # Waits for the cancelled turn to finish and keeps the summarizer out meanwhile
+        async with summarizer.lock(chat_id):
+            snapshot = await chat_with_model.aget_state(config)
+            messages = snapshot.values.get("messages", [])
+            # Nothing to do if the turn was cancelled before its reply was saved
+            if len(messages) < 2 or not isinstance(messages[-1], AIMessage) or not isinstance(messages[-2], HumanMessage) or messages[-2].content != user_text:
+                return
+            if messages[-1].content == said:
+                return
+            trimmed = messages[:-1] + ([AIMessage(said)] if said else [])
+            await chat_with_model.aupdate_state(config, {"messages": trimmed}, as_node="model")
+    except Exception as e:
+        logger.error(f"Error while trimming interrupted reply of conversation {chat_id} -> {str(e)}")
+
+
 
 
 
@@ -140,7 +303,7 @@ async def greet_user(name):
     SystemMessage("Greet user like 'good morning how is your day going' or 'good afternoon  how is my favarite person doing today' based on the time. Don't use these same examples be creative make your own"),
     HumanMessage(f"user name is : {name} and time right now is: {datetime.now().strftime('%I:%M %p')}"),]
 
-    return model.invoke(messages)
+    return await model.ainvoke(messages)
 
 
 
@@ -150,29 +313,44 @@ async def greet_user(name):
 # Get langchain chat history
 from langchain_core.messages import AIMessage
 
-def get_chat_history(chat_with_model, call_id):
+def pair_chat_messages(messages):
+    """Turns the conversation messages into [{"user_query": ..., "ai_response": ...}]"""
+    pairs = []
+    user_msg = None
+
+    for msg in messages:
+        if isinstance(msg, HumanMessage):
+            user_msg = msg.content
+        elif isinstance(msg, AIMessage) and user_msg:
+            pairs.append({
+                "user_query": user_msg,
+                "ai_response": msg.content
+            })
+            user_msg = None  
+
+    return pairs
+
+
+async def aget_chat_history(chat_with_model, call_id):
     try:
         config = {"configurable": {"thread_id": str(call_id)}}
-        state_snapshot = chat_with_model.get_state(config)
-        messages = state_snapshot.values.get("messages", [])
+        state_snapshot = await chat_with_model.aget_state(config)
+        return pair_chat_messages(state_snapshot.values.get("messages", []))
 
-        pairs = []
-        user_msg = None
+    except Exception as e:
+        logger.exception(f"Error in aget_chat_history in Langchain_service.py -> {str(e)}")
+        return []
 
-        for msg in messages:
-            if isinstance(msg, HumanMessage):
-                user_msg = msg.content
-            elif isinstance(msg, AIMessage) and user_msg:
-                pairs.append({
-                    "user_query": user_msg,
-                    "ai_response": msg.content
-                })
-                user_msg = None  
 
-        return pairs
+def get_chat_history(chat_with_model, call_id):
+    """Blocking version of aget_chat_history"""
+    try:
+        config = {"configurable": {"thread_id": str(call_id)}}
+        state_snapshot = chat_with_model.get_state(config)
+        return pair_chat_messages(state_snapshot.values.get("messages", []))
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.exception(f"Error in get_chat_history in Langchain_service.py -> {str(e)}")
         return []
 
 
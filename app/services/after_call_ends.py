@@ -1,7 +1,11 @@
 
 
 
-from services.mongodb_service import upload_on_mongodb
+from services.mongodb_service import upload_on_mongodb, upload_chat_history_on_mongodb
+
+import asyncio
+import os
+import uuid
 
 # For sentiment analysis
 from services.sentiment_analysis import check_sentiment_using_textblob
@@ -21,7 +25,7 @@ from services.postgres import get_carehome_email
 
 # For getting carehome id from patient id in postgresql
 # For updating status to completed after the call
-from services.postgres import get_carehome_id_from_patient_id, did_change_status_to_completed
+from services.postgres import get_carehome_id_from_patient_id, did_change_status_to_completed, adid_change_status_to_completed
 
 
 
@@ -141,6 +145,17 @@ def change_call_status_to_completed(patient_id):
         raise
 
 
+async def achange_call_status_to_completed(patient_id, schedule_id):
+    """Async version of change_call_status_to_completed, for the scheduled call `schedule_id`"""
+    try:
+        did_change = await adid_change_status_to_completed(patient_id, schedule_id)
+        if did_change:
+            return True
+    except Exception as e:
+        logger.exception(f"achange_call_status_to_completed in after_call_ends.py  in services -> {e}")
+        raise
+
+
 
 
 
@@ -150,20 +165,73 @@ def check_chat_for_possible_word(messages, patient_id):
 
     suspected_line = detect_harmful_line(messages)
 
+    if suspected_line:
+        return send_safety_alert(patient_id, suspected_line)
+    return True
+
+
+# Email the carehome about a concerning message of the patient
+def send_safety_alert(patient_id, suspected_line):
     carehome_email = get_carehome_email(patient_id)
 
-    if suspected_line:
-        subject = "Urgent: Concerning Message Detected"
-        body = f"""
-        Warning: A concerning message was detected that may indicate self-harm or harm to others.
-    
-        Suspected message:
-        "{suspected_line}"
+    subject = "Urgent: Concerning Message Detected"
+    body = f"""
+    Warning: A concerning message was detected that may indicate self-harm or harm to others.
 
-        Please check on the user immediately.
-        """
-        did_send = send_email_alert(carehome_email,subject,body)
-        return did_send
-    return True
+    Suspected message:
+    "{suspected_line}"
+
+    Please check on the user immediately.
+    """
+    did_send = send_email_alert(carehome_email,subject,body)
+    return did_send
     
     
+
+
+
+# Steps of the post call job (see services/post_call_queue.py), in order. Every step gets the job
+# (call_id, patient_id, carehome_id, schedule_id, chat_history) and the results of the steps before it
+async def sentiment_step(job, results):
+    return check_sentiment_using_textblob(job["chat_history"])
+
+
+async def save_transcript_step(job, results):
+    # call_id is a uuid in Mongo, the spool keeps it as a string
+    return await upload_chat_history_on_mongodb(job["patient_id"], uuid.UUID(job["call_id"]), job["chat_history"], job["carehome_id"], results["sentiment"],
+                                                 unsaved_from=job.get("unsaved_from", 0), stored_turns=job.get("stored_turns", 0))
+
+
+async def status_step(job, results):
+    if not job.get("schedule_id"):
+        # Not a scheduled call (or a job spooled before schedule_id was added), nothing to complete
+        logger.warning(f"Post call job of call {job['call_id']} has no schedule_id, status not changed")
+        return False
+    return bool(await achange_call_status_to_completed(job["patient_id"], job["schedule_id"]))
+
+
+async def safety_step(job, results):
+    """The concerning line of the call, False if there is none"""
+    user_messages = " ".join(turn["user_query"] for turn in job["chat_history"])
+    if not user_messages.strip():
+        return False
+    # OpenAI call is blocking
+    return await asyncio.to_thread(detect_harmful_line, user_messages)
+
+
+async def safety_alert_step(job, results):
+    if not results["safety"]:
+        return False
+    return await asyncio.to_thread(send_safety_alert, job["patient_id"], results["safety"])
+
+
+# Options (see PostCallQueue): "timeout": False -> no step timeout (a thread can't be stopped,
+# a retry would run it a second time), "retry": False -> at most once, never sent twice
+POST_CALL_STEPS = [
+    ("sentiment", sentiment_step),
+    ("save_transcript", save_transcript_step),
+    ("status", status_step),
+]
+if os.getenv("POST_CALL_SAFETY_CHECKS", "false").lower() in ("true", "1"):
+    POST_CALL_STEPS.append(("safety", safety_step, {"timeout": False}))
+    POST_CALL_STEPS.append(("safety_alert", safety_alert_step, {"timeout": False, "retry": False}))
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import msgpack
+from sqlalchemy.dialects.postgresql import insert
+
+logger = logging.getLogger(__name__)
+
+
+# A conversation is stored as one blob: its checkpoints and pending writes, exactly as
+# MemorySaver holds them (already serialized by the graph's serde), packed with msgpack.
+
+def encode_thread(namespaces: dict, writes: dict) -> bytes:
+    """`namespaces`: MemorySaver.storage[thread_id], `writes`: the MemorySaver.writes entries of the thread"""
+    checkpoints = []
+    for checkpoint_ns, saved in namespaces.items():
+        for checkpoint_id, (checkpoint, metadata, parent_id) in saved.items():
+            checkpoints.append([checkpoint_ns, checkpoint_id, checkpoint[0], checkpoint[1], metadata[0], metadata[1], parent_id])
+    pending_writes = []
+    for (_, checkpoint_ns, checkpoint_id), task_writes in writes.items():
+        for (task_id, index), (_, channel, value, task_path) in task_writes.items():
+            pending_writes.append([checkpoint_ns, checkpoint_id, task_id, index, channel, value[0], value[1], task_path])
+    return msgpack.packb({"checkpoints": checkpoints, "writes": pending_writes}, use_bin_type=True)
+
+
+def decode_thread(thread_id: str, data: bytes):
+    """Inverse of encode_thread, returns (namespaces, writes) in MemorySaver's layout"""
+    unpacked = msgpack.unpackb(data, raw=False)
+    namespaces = {}
+    for checkpoint_ns, checkpoint_id, c_type, c_bytes, m_type, m_bytes, parent_id in unpacked["checkpoints"]:
+        namespaces.setdefault(checkpoint_ns, {})[checkpoint_id] = ((c_type, c_bytes), (m_type, m_bytes), parent_id)
+    writes = {}
+    for checkpoint_ns, checkpoint_id, task_id, index, channel, v_type, v_bytes, task_path in unpacked["writes"]:
+        writes.setdefault((thread_id, checkpoint_ns, checkpoint_id), {})[(task_id, index)] = (task_id, channel, (v_type, v_bytes), task_path)
+    return namespaces, writes
+
+
+class PostgresCheckpointStore:
+    """Conversations in the conversation_checkpoints table of the app's Postgres database.
+    SQLAlchemy is sync here, so every query runs in a worker thread. Conversations not
+    updated for `ttl_seconds` are deleted, checked every `sweep_seconds`."""
+
+    def __init__(self, engine, ttl_seconds: float, sweep_seconds: float = 300):
+        self.engine = engine
+        self.ttl_seconds = ttl_seconds
+        self.sweep_seconds = sweep_seconds
+        self.last_sweep = 0.0
+        self.table_ready = False
+
+    def _ensure_table(self):
+        if not self.table_ready:
+            from model.conversation_checkpoint import ConversationCheckpoint
+            ConversationCheckpoint.__table__.create(self.engine, checkfirst=True)
+            self.table_ready = True
+
+    def _save_many(self, threads: dict):
+        from model.conversation_checkpoint import ConversationCheckpoint
+        self._ensure_table()
+        table = ConversationCheckpoint.__table__
+        now = datetime.now(timezone.utc)
+        # Upsert, so two workers flushing the same conversation don't collide on the primary key
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.thread_id],
+            set_={"data": statement.excluded.data, "updated_at": statement.excluded.updated_at},
+        )
+        with self.engine.begin() as connection:
+            # Same row order in every batch, so two concurrent batches don't deadlock
+            connection.execute(statement, [{"thread_id": thread_id, "data": threads[thread_id], "updated_at": now} for thread_id in sorted(threads)])
+            if time.monotonic() - self.last_sweep >= self.sweep_seconds:
+                self.last_sweep = time.monotonic()
+                connection.execute(table.delete().where(table.c.updated_at < now - timedelta(seconds=self.ttl_seconds)))
+
+    def _load(self, thread_id: str) -> Optional[bytes]:
+        from model.conversation_checkpoint import ConversationCheckpoint
+        self._ensure_table()
+        table = ConversationCheckpoint.__table__
+        with self.engine.connect() as connection:
+            return connection.execute(table.select().with_only_columns(table.c.data).where(table.c.thread_id == thread_id)).scalar()
+
+    async def save_many(self, threads: dict):
+        """`threads`: thread_id -> encoded conversation"""
+        await asyncio.to_thread(self._save_many, threads)
+
+    async def load(self, thread_id: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._load, thread_id)
+
+
+class MongoCheckpointStore:
+    """Conversations in the conversation_checkpoints collection, one document per thread.
+    A TTL index drops conversations not updated for `ttl_seconds`."""
+
+    def __init__(self, db, ttl_seconds: float):
+        self.collection = db["conversation_checkpoints"]
+        self.ttl_seconds = ttl_seconds
+        self.index_ready = False
+
+    async def _ensure_index(self):
+        if not self.index_ready:
+            await self.collection.create_index("updated_at", expireAfterSeconds=int(self.ttl_seconds))
+            self.index_ready = True
+
+    async def save_many(self, threads: dict):
+        from pymongo import ReplaceOne
+        await self._ensure_index()
+        now = datetime.now(timezone.utc)
+        await self.collection.bulk_write(
+            [ReplaceOne({"_id": thread_id}, {"_id": thread_id, "data": data, "updated_at": now}, upsert=True) for thread_id, data in threads.items()],
+            ordered=False,
+        )
+
+    async def load(self, thread_id: str) -> Optional[bytes]:
+        document = await self.collection.find_one({"_id": thread_id}, {"data": 1})
+        return bytes(document["data"]) if document else None
@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from dotenv import load_dotenv
+from langgraph.checkpoint.memory import MemorySaver
+
+# For sharing conversations between workers
+from services.checkpoint_store import PostgresCheckpointStore, MongoCheckpointStore, encode_thread, decode_thread
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedMemorySaver(MemorySaver):
+    """MemorySaver that doesn't keep every conversation for the lifetime of the process.
+
+    - At most `max_threads` conversations (thread_id = chat id of a call) are kept,
+      the least recently used one is evicted first.
+    - A conversation not used for `ttl_seconds` is evicted.
+    - Only the last `max_checkpoints_per_thread` checkpoints of a conversation are kept,
+      older ones are never read again when the conversation continues.
+    - `delete_thread` drops a conversation right away (called when the call ends).
+    """
+
+    def __init__(self, max_threads: int, ttl_seconds: float, max_checkpoints_per_thread: int = 3, **kwargs):
+        super().__init__(**kwargs)
+        self.max_threads = max_threads
+        self.ttl_seconds = ttl_seconds
+        self.max_checkpoints_per_thread = max(max_checkpoints_per_thread, 2)
+        self.last_used = OrderedDict()      # thread_id -> last time used, least recent first
+        self.lock = threading.RLock()
+        self.evicted_threads = 0
+
+    def get_tuple(self, config):
+        with self.lock:
+            thread_id = config["configurable"]["thread_id"]
+            # Don't let a lookup of an unknown conversation create empty entries
+            if thread_id not in self.storage:
+                return None
+            self._touch(thread_id)
+            return super().get_tuple(config)
+
+    def list(self, config, **kwargs):
+        with self.lock:
+            return iter(list(super().list(config, **kwargs)))
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self.lock:
+            thread_id = config["configurable"]["thread_id"]
+            saved_config = super().put(config, checkpoint, metadata, new_versions)
+            self._touch(thread_id)
+            self._prune_checkpoints(thread_id, config["configurable"]["checkpoint_ns"])
+            self._evict()
+            return saved_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        with self.lock:
+            self._touch(config["configurable"]["thread_id"])
+            return super().put_writes(config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id: str):
+        """Removes everything stored for a conversation"""
+        with self.lock:
+            namespaces = self.storage.pop(thread_id, {})
+            for checkpoint_ns, checkpoints in namespaces.items():
+                for checkpoint_id in checkpoints:
+                    self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            self.last_used.pop(thread_id, None)
+
+    def stats(self) -> dict:
+        """Number of conversations and bytes of serialized state held in memory"""
+        with self.lock:
+            self._evict()
+            checkpoint_bytes = 0
+            for namespaces in self.storage.values():
+                for checkpoints in namespaces.values():
+                    for checkpoint, metadata, _ in checkpoints.values():
+                        checkpoint_bytes += len(checkpoint[1]) + len(metadata[1])
+            write_bytes = 0
+            for writes in self.writes.values():
+                for _, _, value, _ in writes.values():
+                    write_bytes += len(value[1])
+            return {
+                "threads": len(self.storage),
+                "max_threads": self.max_threads,
+                "ttl_seconds": self.ttl_seconds,
+                "bytes": checkpoint_bytes + write_bytes,
+                "checkpoint_bytes": checkpoint_bytes,
+                "write_bytes": write_bytes,
+                "evicted_threads": self.evicted_threads,
+            }
+
+    def _touch(self, thread_id: str):
+        self.last_used[thread_id] = time.monotonic()
+        self.last_used.move_to_end(thread_id)
+
+    def _prune_checkpoints(self, thread_id: str, checkpoint_ns: str):
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.max_checkpoints_per_thread:
+            return
+        # Checkpoint ids are time ordered, keep the newest ones
+        for checkpoint_id in sorted(checkpoints)[:-self.max_checkpoints_per_thread]:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.last_used:
+            thread_id, used_at = next(iter(self.last_used.items()))
+            if len(self.last_used) <= self.max_threads and now - used_at < self.ttl_seconds:
+                break
+            self.delete_thread(thread_id)
+            self.evicted_threads += 1
+            logger.info(f"Evicted conversation {thread_id} from chat memory")
+
+
+class PersistentMemorySaver(BoundedMemorySaver):
+    """BoundedMemorySaver that also keeps every conversation in a store shared by all
+    workers (see services/checkpoint_store.py), so a call that reconnects to another
+    worker or replica resumes its conversation.
+
+    - Turns only read and write memory. Conversations changed since the last flush are
+      written to the store in one batch every `flush_interval` seconds by a background task.
+    - A conversation that isn't in memory is loaded from the store on the async lookup
+      (`aget_tuple`) at the start of a turn, that's the resume by call id. The sync
+      `get_tuple` only looks in memory.
+    - Evicting or releasing a conversation only drops it from memory, changes that
+      weren't flushed yet are still written by the next flush.
+    """
+
+    def __init__(self, store, flush_interval: float, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.flush_interval = flush_interval
+        self.dirty = set()              # thread ids changed in memory since the last flush
+        self.unflushed = {}             # thread id -> encoded conversation, dropped from memory before its flush
+        self.flush_task = None
+
+        self.flushes = 0
+        self.flushed_threads = 0
+        self.flush_failures = 0
+        self.restored_threads = 0
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self.lock:
+            saved_config = super().put(config, checkpoint, metadata, new_versions)
+            self.dirty.add(config["configurable"]["thread_id"])
+            return saved_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        with self.lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self.dirty.add(config["configurable"]["thread_id"])
+
+    def delete_thread(self, thread_id: str):
+        with self.lock:
+            if thread_id in self.dirty:
+                self.dirty.discard(thread_id)
+                self.unflushed[thread_id] = self._encode(thread_id)
+            super().delete_thread(thread_id)
+
+    async def aget_tuple(self, config):
+        self._start_flushing()
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            in_memory = thread_id in self.storage
+        if not in_memory:
+            await self._restore(thread_id)
+        return self.get_tuple(config)
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        self._start_flushing()
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        self._start_flushing()
+        return self.put_writes(config, writes, task_id, task_path)
+
+    async def flush(self):
+        """Writes every conversation changed since the last flush to the store"""
+        with self.lock:
+            threads = dict(self.unflushed)
+            self.unflushed.clear()
+            for thread_id in self.dirty:
+                threads[thread_id] = self._encode(thread_id)
+            self.dirty.clear()
+        if not threads:
+            return
+
+        try:
+            await self.store.save_many(threads)
+            self.flushes += 1
+            self.flushed_threads += len(threads)
+        except Exception as e:
+            self.flush_failures += 1
+            logger.error(f"Error while saving {len(threads)} conversations to the checkpoint store -> {str(e)}")
+            # Try again on the next flush
+            with self.lock:
+                for thread_id, data in threads.items():
+                    if thread_id in self.storage:
+                        self.dirty.add(thread_id)
+                    else:
+                        self.unflushed.setdefault(thread_id, data)
+
+    async def aclose(self):
+        """Stops the background flush and writes what is left, called on shutdown"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self.lock:
+            stats.update({
+                "store": type(self.store).__name__,
+                "dirty_threads": len(self.dirty) + len(self.unflushed),
+                "flushes": self.flushes,
+                "flushed_threads": self.flushed_threads,
+                "flush_failures": self.flush_failures,
+                "restored_threads": self.restored_threads,
+            })
+        return stats
+
+    def _encode(self, thread_id: str) -> bytes:
+        # Caller holds the lock
+        writes = {key: value for key, value in self.writes.items() if key[0] == thread_id}
+        return encode_thread(self.storage.get(thread_id, {}), writes)
+
+    async def _restore(self, thread_id: str):
+        with self.lock:
+            data = self.unflushed.get(thread_id)
+        if data is None:
+            try:
+                data = await self.store.load(thread_id)
+            except Exception as e:
+                logger.error(f"Error while loading conversation {thread_id} from the checkpoint store -> {str(e)}")
+                return
+        if data is None:
+            return
+
+        namespaces, writes = decode_thread(thread_id, data)
+        with self.lock:
+            if thread_id in self.storage:
+                return
+            self.storage[thread_id] = defaultdict(dict, namespaces)
+            self.writes.update(writes)
+            self._touch(thread_id)
+            self._evict()
+            self.restored_threads += 1
+        logger.info(f"Resumed conversation {thread_id} from the checkpoint store")
+
+    def _start_flushing(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+def create_checkpointer():
+    """CHAT_MEMORY_BACKEND picks where conversations live:
+        - memory (default): only in this worker's memory
+        - postgres / mongo: in memory and in the shared database, so any worker can resume them"""
+    options = {
+        "max_threads": int(os.getenv("CHAT_MEMORY_MAX_THREADS", "1000")),
+        "ttl_seconds": float(os.getenv("CHAT_MEMORY_TTL_SECONDS", "1800")),
+        "max_checkpoints_per_thread": int(os.getenv("CHAT_MEMORY_MAX_CHECKPOINTS", "3")),
+    }
+    backend = os.getenv("CHAT_MEMORY_BACKEND", "memory").lower()
+    store_ttl_seconds = float(os.getenv("CHAT_MEMORY_STORE_TTL_SECONDS", "86400"))
+
+    if backend == "postgres":
+        from db.postgres import engine
+        store = PostgresCheckpointStore(engine, store_ttl_seconds, sweep_seconds=float(os.getenv("CHAT_MEMORY_STORE_SWEEP_SECONDS", "300")))
+    elif backend == "mongo":
+        from db.mongo_db import db
+        store = MongoCheckpointStore(db, store_ttl_seconds)
+    else:
+        return BoundedMemorySaver(**options)
+
+    return PersistentMemorySaver(store, flush_interval=float(os.getenv("CHAT_MEMORY_FLUSH_SECONDS", "0.5")), **options)
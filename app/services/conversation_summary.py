@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+# For finding the turns that are about to fall out of the prompt window
+from utils.token_budget import select_history
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+SUMMARY_INSTRUCTION = """You keep a running summary of a therapy conversation between Elys (a companion bot) and a patient with dementia.
+Update the summary with the new turns. Keep names, people, places, stories the patient shared, how they feel and anything Elys promised or asked.
+Write it in the third person, at most 150 words, and return only the summary."""
+
+
+def format_turns(messages: list) -> str:
+    lines = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            lines.append(f"Patient: {message.content}")
+        elif isinstance(message, AIMessage):
+            lines.append(f"Elys: {message.content}")
+    return "\n".join(lines)
+
+
+class ConversationSummarizer:
+    """Folds the turns that no longer fit in the prompt window into a running summary
+    stored in the conversation state ("summary", "summarized_count").
+
+    Runs as a background task after a turn has been answered, never during one. The
+    summary is written with `aupdate_state`, a turn that runs at the same time would
+    overwrite it with the state it started from, so turns and the summary write share
+    a per conversation lock (`lock(chat_id)`). Only the write takes the lock, the LLM
+    request for the summary runs without it.
+
+    Turns start getting summarized once they fall out of `window_ratio` of the token
+    budget, a bit before the prompt window drops them, so nothing is ever missing from
+    both the summary and the window.
+    """
+
+    def __init__(self, graph, model, budget: int, window_ratio: float = 0.75, min_messages: int = 4):
+        self.graph = graph
+        self.model = model
+        self.budget = budget
+        self.window_ratio = window_ratio
+        self.min_messages = min_messages
+
+        self.locks = {}         # chat id -> asyncio.Lock
+        self.tasks = {}         # chat id -> running summary task
+
+        self.summaries = 0
+        self.failures = 0
+
+    def lock(self, chat_id) -> asyncio.Lock:
+        return self.locks.setdefault(str(chat_id), asyncio.Lock())
+
+    def schedule(self, chat_id):
+        """Starts summarizing in the background if nothing is running for this conversation yet.
+        Has to be called from the event loop."""
+        chat_id = str(chat_id)
+        if chat_id in self.tasks:
+            return
+        task = asyncio.create_task(self.summarize(chat_id))
+        self.tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(chat_id, None))
+
+    def release(self, chat_id):
+        """Called when the call ends"""
+        chat_id = str(chat_id)
+        task = self.tasks.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+        self.locks.pop(chat_id, None)
+
+    async def summarize(self, chat_id: str):
+        config = {"configurable": {"thread_id": chat_id}}
+        try:
+            snapshot = await self.graph.aget_state(config)
+            state = snapshot.values
+            messages = state.get("messages", [])
+            summary = state.get("summary", "")
+            summarized_count = state.get("summarized_count", 0)
+            if not state.get("system_prompt"):
+                return
+
+            window = select_history(state["system_prompt"] + summary, messages[summarized_count:], int(self.budget * self.window_ratio))
+            end = len(messages) - len(window)
+            new_turns = messages[summarized_count:end]
+            if len(new_turns) < self.min_messages:
+                return
+
+            request = [
+                SystemMessage(SUMMARY_INSTRUCTION),
+                HumanMessage(f"Summary so far:\n{summary or 'Nothing yet.'}\n\nNew turns:\n{format_turns(new_turns)}"),
+            ]
+            response = await self.model.ainvoke(request)
+
+            async with self.lock(chat_id):
+                await self.graph.aupdate_state(config, {"summary": response.content.strip(), "summarized_count": end}, as_node="model")
+            self.summaries += 1
+            logger.info(f"Summarized {len(new_turns)} messages of conversation {chat_id}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error while summarizing conversation {chat_id} -> {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self.tasks),
+            "summaries": self.summaries,
+            "failures": self.failures,
+        }
+
+
+def create_summarizer(graph, model, budget: int) -> ConversationSummarizer:
+    return ConversationSummarizer(
+        graph,
+        model,
+        budget,
+        window_ratio=float(os.getenv("SUMMARY_WINDOW_RATIO", "0.75")),
+        min_messages=int(os.getenv("SUMMARY_MIN_MESSAGES", "4")),
+    )
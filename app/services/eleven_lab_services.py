@@ -1,14 +1,52 @@
 import requests
+import httpx
 import io
 import os
-from typing import Optional
+import importlib.util
+from typing import AsyncIterator, Optional
 from fastapi import HTTPException
 
+# Cache in front of every text to speech request
+from services.tts_cache import tts_cache
+
+
+# Timeouts (seconds) and connection pool size for requests to ElevenLabs
+CONNECT_TIMEOUT = float(os.getenv("ELEVENLABS_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("ELEVENLABS_READ_TIMEOUT", "15"))
+MAX_CONNECTIONS = int(os.getenv("ELEVENLABS_MAX_CONNECTIONS", "50"))
+
+# Keep-alive connections for the blocking client
+session = requests.Session()
+
 
 class ElevenLabsService:
     """Service to handle interactions with ElevenLabs API for text-to-speech"""
     
     BASE_URL = "https://api.elevenlabs.io/v1"
+    MODEL_ID = "eleven_turbo_v2"  # Fastest model for real-time applications
+    VOICE_SETTINGS = {
+        "stability": 0.5,
+        "similarity_boost": 0.75,
+        "style": 0.0,
+        "use_speaker_boost": True
+    }
+
+    @staticmethod
+    def build_payload(text: str, optimize_streaming_latency: Optional[int] = 4) -> dict:
+        return {
+            "text": text,
+            "model_id": ElevenLabsService.MODEL_ID,
+            "voice_settings": ElevenLabsService.VOICE_SETTINGS,
+            "optimize_streaming_latency": optimize_streaming_latency
+        }
+
+    @staticmethod
+    def build_headers() -> dict:
+        return {
+            "xi-api-key": os.getenv("ELEVENLABS_API_KEY"),
+            "Content-Type": "application/json",
+            "Accept": "audio/mpeg"
+        }
     
     @staticmethod
     def get_voices():
@@ -39,27 +77,19 @@ class ElevenLabsService:
         """
         url = f"{ElevenLabsService.BASE_URL}/text-to-speech/{voice_id}/stream"
         
-        payload = {
-            "text": text,
-            "model_id": "eleven_turbo_v2",  # Fastest model for real-time applications
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.75,
-                "style": 0.0,
-                "use_speaker_boost": True
-            },
-            "optimize_streaming_latency": optimize_streaming_latency
-        }
+        payload = ElevenLabsService.build_payload(text, optimize_streaming_latency)
+
+        cache_key = tts_cache.make_key(voice_id, payload)
+        cached_audio = tts_cache.get(cache_key)
+        if cached_audio is not None:
+            return cached_audio
         
-        response = requests.post(
+        response = session.post(
             url,
-            headers={
-                "xi-api-key": os.getenv("ELEVENLABS_API_KEY"),
-                "Content-Type": "application/json",
-                "Accept": "audio/mpeg"
-            },
+            headers=ElevenLabsService.build_headers(),
             json=payload,
-            stream=True
+            stream=True,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
         )
         
         if response.status_code != 200:
@@ -73,7 +103,97 @@ class ElevenLabsService:
                 buffer.write(chunk)
         
         buffer.seek(0)
-        return buffer.read()
+        audio = buffer.read()
+        tts_cache.put(cache_key, audio)
+        return audio
+
+
+
+class AsyncElevenLabsService:
+    """Async version of ElevenLabsService.text_to_speech for the websocket routes.
+
+    Audio is served from tts_cache when the same text was already synthesized with the
+    same voice and settings. All requests share one httpx.AsyncClient, so the connections (and TLS sessions)
+    to ElevenLabs are kept alive between turns instead of a new handshake per utterance.
+    HTTP/2 is used when the `h2` package is installed.
+    """
+
+    _client: Optional[httpx.AsyncClient] = None
+
+    @classmethod
+    def get_client(cls) -> httpx.AsyncClient:
+        if cls._client is None or cls._client.is_closed:
+            cls._client = httpx.AsyncClient(
+                base_url=ElevenLabsService.BASE_URL,
+                http2=importlib.util.find_spec("h2") is not None,
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_CONNECTIONS,
+                    keepalive_expiry=120
+                )
+            )
+        return cls._client
+
+    @classmethod
+    async def close(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+
+    @classmethod
+    async def stream_text_to_speech(cls, text: str, voice_id: str, optimize_streaming_latency: Optional[int] = 4, timeout: Optional[float] = None) -> AsyncIterator[bytes]:
+        """
+        Convert text to speech, yielding the audio chunks as ElevenLabs sends them
+
+        Args:
+            text: The text to convert to speech
+            voice_id: The ElevenLabs voice ID to use
+            optimize_streaming_latency: Level of optimization (0-4, higher = lower latency)
+            timeout: Seconds to wait for the next chunk of this request (defaults to READ_TIMEOUT)
+
+        Yields:
+            Audio data as bytes
+        """
+        payload = ElevenLabsService.build_payload(text, optimize_streaming_latency)
+
+        cache_key = tts_cache.make_key(voice_id, payload)
+        cached_audio = await tts_cache.aget(cache_key)
+        if cached_audio is not None:
+            yield cached_audio
+            return
+
+        client = cls.get_client()
+        request_timeout = httpx.Timeout(timeout or READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+        async with client.stream(
+            "POST",
+            f"/text-to-speech/{voice_id}/stream",
+            headers=ElevenLabsService.build_headers(),
+            json=payload,
+            timeout=request_timeout
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise HTTPException(status_code=response.status_code, 
+                                   detail=f"ElevenLabs API error: {response.text}")
+
+            chunks = []
+            async for chunk in response.aiter_bytes():
+                if chunk:
+                    chunks.append(chunk)
+                    yield chunk
+
+        # Only cached once the whole audio has been received
+        tts_cache.aput(cache_key, b"".join(chunks))
+
+    @classmethod
+    async def text_to_speech(cls, text: str, voice_id: str, optimize_streaming_latency: Optional[int] = 4, timeout: Optional[float] = None) -> bytes:
+        """Same as stream_text_to_speech but returns the whole audio as bytes"""
+        chunks = []
+        async for chunk in cls.stream_text_to_speech(text, voice_id, optimize_streaming_latency, timeout):
+            chunks.append(chunk)
+        return b"".join(chunks)
     
     
     
@@ -0,0 +1,287 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from langchain.chat_models import init_chat_model
+from langchain_core.messages import AIMessage, message_chunk_to_message
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# Marks the end of a provider's stream in the router queue
+STREAM_DONE = object()
+
+
+class LLMProvider:
+    """One chat model plus its rolling time-to-first-token samples and health.
+
+    A provider that fails is put in a cooldown (doubling on every failure in a row,
+    up to `max_cooldown_seconds`), a success clears it.
+    """
+
+    def __init__(self, name: str, model, window: int = 50, cooldown_seconds: float = 10, max_cooldown_seconds: float = 300):
+        self.name = name
+        self.model = model
+        self.ttft = deque(maxlen=window)       # seconds, most recent last
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.wins = 0
+        self.failures = 0
+        self.failures_in_a_row = 0
+        self.cooldown_until = 0.0
+
+        # Token usage reported by the provider, cached = prompt prefix served from its prompt cache
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+
+    def percentile(self, percent: float):
+        with self.lock:
+            samples = sorted(self.ttft)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def record_ttft(self, seconds: float):
+        with self.lock:
+            self.ttft.append(seconds)
+
+    def record_usage(self, usage: dict):
+        """`usage`: usage_metadata of a response or of the last chunk of a stream"""
+        with self.lock:
+            self.input_tokens += usage.get("input_tokens", 0)
+            self.output_tokens += usage.get("output_tokens", 0)
+            self.cached_input_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+
+    def record_success(self):
+        with self.lock:
+            self.failures_in_a_row = 0
+            self.cooldown_until = 0.0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.failures_in_a_row += 1
+            cooldown = min(self.cooldown_seconds * 2 ** (self.failures_in_a_row - 1), self.max_cooldown_seconds)
+            self.cooldown_until = time.monotonic() + cooldown
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.is_healthy(),
+            "ttft_p50": self.percentile(50),
+            "ttft_p95": self.percentile(95),
+            "samples": len(self.ttft),
+            "requests": self.requests,
+            "wins": self.wins,
+            "failures": self.failures,
+            "cooldown_remaining": max(0.0, self.cooldown_until - time.monotonic()),
+            "input_tokens": self.input_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_input_ratio": self.cached_input_tokens / self.input_tokens if self.input_tokens else 0.0,
+        }
+
+
+class LLMRouter:
+    """Sends every LLM request to the fastest healthy provider (lowest p95 time to
+    first token). If that provider hasn't produced a token within `hedge_deadline`
+    seconds, the same request is also sent to the next provider and whichever
+    streams a token first wins, the other request is cancelled.
+
+    Has the invoke / ainvoke / astream methods the rest of the code uses on a chat model.
+    """
+
+    def __init__(self, providers: list, hedge_deadline: float):
+        self.providers = providers
+        self.hedge_deadline = hedge_deadline
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def ranked(self) -> list:
+        """Healthy providers fastest first (no samples yet counts as fastest so they get
+        measured), providers in cooldown last as a last resort"""
+        def key(provider):
+            p95 = provider.percentile(95)
+            return (not provider.is_healthy(), p95 if p95 is not None else 0.0)
+        return sorted(self.providers, key=key)
+
+    async def astream(self, messages):
+        """Yields the chunks of the winning provider's reply"""
+        queue = asyncio.Queue()
+        remaining = self.ranked()
+        tasks = {}              # provider -> streaming task
+        buffered = {}           # provider -> chunks received before a winner was picked
+        lost_race = set()       # providers cancelled because another one streamed first
+        winner = None
+        hedged = False
+        loop = asyncio.get_running_loop()
+        hedge_at = loop.time() + self.hedge_deadline
+
+        def launch(provider):
+            provider.requests += 1
+            buffered[provider] = []
+            tasks[provider] = asyncio.create_task(self._stream_provider(provider, messages, queue, lost_race))
+
+        launch(remaining.pop(0))
+        try:
+            while True:
+                timeout = None
+                if winner is None and not hedged and remaining:
+                    timeout = max(0.0, hedge_at - loop.time())
+                try:
+                    provider, item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedged = True
+                    self.hedges += 1
+                    logger.info(f"No LLM token within {self.hedge_deadline}s, hedging with {remaining[0].name}")
+                    launch(remaining.pop(0))
+                    continue
+
+                if winner is not None and provider is not winner:
+                    continue
+
+                if isinstance(item, Exception):
+                    if provider is winner:
+                        raise item
+                    tasks.pop(provider, None)
+                    if tasks:
+                        continue
+                    if not remaining:
+                        raise item
+                    # Nothing else in flight, fail over right away
+                    hedged = True
+                    launch(remaining.pop(0))
+                    continue
+
+                if item is STREAM_DONE:
+                    if winner is None:
+                        # Finished without a single token, still a (blank) reply
+                        self._pick_winner(provider, tasks, lost_race)
+                        for chunk in buffered[provider]:
+                            yield chunk
+                    return
+
+                if winner is None:
+                    buffered[provider].append(item)
+                    if item.content:
+                        winner = provider
+                        self._pick_winner(provider, tasks, lost_race)
+                        for chunk in buffered[provider]:
+                            yield chunk
+                else:
+                    yield item
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    async def ainvoke(self, messages):
+        full_chunk = None
+        async for chunk in self.astream(messages):
+            full_chunk = chunk if full_chunk is None else full_chunk + chunk
+        if full_chunk is None:
+            return AIMessage("")
+        return message_chunk_to_message(full_chunk)
+
+    def invoke(self, messages):
+        """Blocking version, no hedging: tries the providers fastest first until one answers"""
+        error = None
+        for provider in self.ranked():
+            provider.requests += 1
+            try:
+                response = provider.model.invoke(messages)
+            except Exception as e:
+                logger.error(f"LLM provider {provider.name} failed -> {str(e)}")
+                provider.record_failure()
+                error = e
+                continue
+            provider.record_success()
+            provider.wins += 1
+            if response.usage_metadata:
+                provider.record_usage(response.usage_metadata)
+            return response
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            "hedge_deadline": self.hedge_deadline,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "providers": {provider.name: provider.stats() for provider in self.providers},
+        }
+
+    def _pick_winner(self, provider: LLMProvider, tasks: dict, lost_race: set):
+        provider.wins += 1
+        if len(tasks) > 1 and provider is not next(iter(tasks)):
+            self.hedge_wins += 1
+        for other, task in tasks.items():
+            if other is not provider:
+                lost_race.add(other)
+                task.cancel()
+
+    async def _stream_provider(self, provider: LLMProvider, messages, queue: asyncio.Queue, lost_race: set):
+        started = time.monotonic()
+        got_token = False
+        try:
+            async for chunk in provider.model.astream(messages):
+                if not got_token and chunk.content:
+                    got_token = True
+                    provider.record_ttft(time.monotonic() - started)
+                if chunk.usage_metadata:
+                    provider.record_usage(chunk.usage_metadata)
+                queue.put_nowait((provider, chunk))
+            provider.record_success()
+            queue.put_nowait((provider, STREAM_DONE))
+        except asyncio.CancelledError:
+            # Lost the race before its first token: the time it had taken so far is a
+            # lower bound of its TTFT, record it so a slow provider stops looking fast.
+            # Not when the whole request was cancelled (barge-in, caller gone)
+            if not got_token and provider in lost_race:
+                provider.record_ttft(time.monotonic() - started)
+            raise
+        except Exception as e:
+            logger.error(f"LLM provider {provider.name} failed -> {str(e)}")
+            provider.record_failure()
+            queue.put_nowait((provider, e))
+
+
+def create_llm_router() -> LLMRouter:
+    """Providers come from LLM_PROVIDERS, "provider:model" comma separated and in order of
+    preference, e.g. "openai:gpt-3.5-turbo-0125,groq:llama3-8b-8192". A provider whose
+    package or API key is missing is skipped."""
+    providers = []
+    for entry in os.getenv("LLM_PROVIDERS", "openai:gpt-3.5-turbo-0125").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        provider_name, _, model_name = entry.partition(":")
+        # OpenAI only reports token usage (and cached tokens) on streams if asked to
+        options = {"stream_usage": True} if provider_name == "openai" else {}
+        try:
+            model = init_chat_model(model_name, model_provider=provider_name, **options)
+        except Exception as e:
+            logger.error(f"Couldn't set up LLM provider {entry} -> {str(e)}")
+            continue
+        providers.append(LLMProvider(
+            entry,
+            model,
+            window=int(os.getenv("LLM_LATENCY_WINDOW", "50")),
+            cooldown_seconds=float(os.getenv("LLM_PROVIDER_COOLDOWN_SECONDS", "10")),
+        ))
+
+    if not providers:
+        raise ValueError("No LLM provider could be set up, check LLM_PROVIDERS and the API keys.")
+
+    return LLMRouter(providers, hedge_deadline=float(os.getenv("LLM_HEDGE_DEADLINE_SECONDS", "1.0")))
@@ -2,6 +2,8 @@ from fastapi import HTTPException
 
 from db.mongo_db import db
 from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 
 
@@ -15,33 +17,158 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-async def upload_chat_history_on_mongodb(patient_id: str, call_id: str, new_chats: list, carehome_id: str, sentiment):
+# One document per call in `calls` (_id = call_id) instead of a `calls` array growing in one
+# `chats` document per patient, plus a small per patient summary in `patient_call_summaries`.
+# Old `chats` documents are moved over by cron_job/migrate_chats_to_calls.py
+calls_collection = db["calls"]
+summaries_collection = db["patient_call_summaries"]
+
+indexes_ready = False
+
+
+async def ensure_call_indexes():
+    global indexes_ready
+    if indexes_ready:
+        return
+    await calls_collection.create_index([("patient_id", 1), ("call_time", -1)])
+    await calls_collection.create_index([("carehome_id", 1), ("call_time", -1)])
+    await calls_collection.create_index("call_time")
+    await summaries_collection.create_index("carehome_id")
+    indexes_ready = True
+
+
+async def save_call(patient_id: str, call_id, carehome_id: str, call_time: datetime, fields: dict) -> bool:
+    """Saves a call in its own document, marks it completed and updates the patient's summary.
+    Saving the same call_id again (post call job retried, or the call reconnected and ended
+    again) replaces the call's fields and doesn't count it twice
+    OUTPUT:
+        - True if the call is new"""
+    await ensure_call_indexes()
+    now = datetime.now(timezone.utc)
+    before = await calls_collection.find_one_and_update(
+        {"_id": call_id},
+        {
+            "$set": {"patient_id": patient_id, "carehome_id": carehome_id, "status": "completed", **fields},
+            "$setOnInsert": {"call_id": call_id, "call_time": call_time},
+            # Time of the first completion, tells if the call was already counted
+            "$min": {"completed_at": now},
+        },
+        upsert=True,
+        projection={"call_time": 1, "completed_at": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    is_new = before is None or "completed_at" not in before
+    # Checkpointed calls keep the time they started at
+    if before is not None and before.get("call_time"):
+        call_time = before["call_time"]
+    await update_patient_summary(patient_id, carehome_id, call_id, call_time, fields.get("sentiment_analysis"), is_new)
+    return is_new
+
+
+async def checkpoint_call(patient_id: str, call_id, carehome_id: str, call_time: datetime, turns: list, start_index: int):
+    """Saves the turns of a call that is still going on at `start_index` of the call's
+    conversation. Only the new turns are written. A new call document gets status
+    in_progress, a completed call (reconnected after it ended) stays completed"""
+    await ensure_call_indexes()
+    await calls_collection.update_one(
+        {"_id": call_id},
+        {
+            "$set": {**conversation_fields(turns, start_index), "updated_at": datetime.now(timezone.utc)},
+            "$setOnInsert": {"call_id": call_id, "call_time": call_time, "patient_id": patient_id, "carehome_id": carehome_id, "status": "in_progress"},
+        },
+        upsert=True,
+    )
+
+
+async def stored_turn_count(call_id) -> int:
+    """Number of turns already saved for the call (0 if it has no document yet)"""
+    result = await calls_collection.aggregate([
+        {"$match": {"_id": call_id}},
+        {"$project": {"turns": {"$size": {"$ifNull": ["$conversation", []]}}}},
+    ]).to_list(length=1)
+    return result[0]["turns"] if result else 0
+
+
+def conversation_fields(turns: list, start_index: int) -> dict:
+    """$set fields that write `turns` at `start_index` of the call's conversation"""
+    if start_index == 0:
+        return {"conversation": turns}
+    # Setting the next indexes appends to the array without sending it all again,
+    # writing the same turns twice is harmless
+    return {f"conversation.{start_index + index}": turn for index, turn in enumerate(turns)}
+
+
+async def update_patient_summary(patient_id: str, carehome_id: str, call_id, call_time: datetime, sentiment, is_new: bool):
+    # Every change bumps `version`, so rebuild_patient_summary can tell it raced with one
+    update = {
+        "$setOnInsert": {"patient_id": patient_id},
+        "$set": {"carehome_id": carehome_id},
+        "$inc": {"version": 1},
+    }
+    if is_new:
+        # sentiment_total / call_count = average sentiment
+        update["$inc"].update({"call_count": 1, "sentiment_total": sentiment or 0})
+        update["$min"] = {"first_call_time": call_time}
+    await summaries_collection.update_one({"_id": patient_id}, update, upsert=True)
+    # Last call only moves forward (jobs can be retried out of order)
+    await summaries_collection.update_one(
+        {"_id": patient_id, "$or": [{"last_call_time": {"$exists": False}}, {"last_call_time": {"$lte": call_time}}]},
+        {"$set": {"last_call_id": call_id, "last_call_time": call_time, "last_sentiment_analysis": sentiment}, "$inc": {"version": 1}},
+    )
+
+
+async def rebuild_patient_summary(patient_id: str, attempts: int = 5) -> bool:
+    """Recomputes a patient's summary from all of their call documents (used by the migration).
+    The summary is only replaced if no call updated it meanwhile (same `version`), otherwise
+    it is computed again
+    OUTPUT:
+        - False if it kept racing with calls of the patient and gave up"""
+    for _ in range(attempts):
+        current = await summaries_collection.find_one({"_id": patient_id}, {"version": 1})
+        summary = await aggregate_patient_summary(patient_id)
+        if summary is None:
+            return True
+        if current is None:
+            try:
+                await summaries_collection.insert_one({**summary, "version": 1})
+                return True
+            except DuplicateKeyError:
+                continue
+        version = current.get("version")
+        guard = {"_id": patient_id, "version": version if version is not None else {"$exists": False}}
+        result = await summaries_collection.replace_one(guard, {**summary, "version": (version or 0) + 1})
+        if result.matched_count:
+            return True
+    logger.warning("Couldn't rebuild the call summary of patient_id %s, it kept changing", patient_id)
+    return False
+
+
+async def aggregate_patient_summary(patient_id: str):
+    summary = await calls_collection.aggregate([
+        {"$match": {"patient_id": patient_id, "status": "completed"}},
+        {"$sort": {"call_time": 1}},
+        {"$group": {
+            "_id": "$patient_id",
+            "carehome_id": {"$last": "$carehome_id"},
+            "call_count": {"$sum": 1},
+            "sentiment_total": {"$sum": {"$ifNull": ["$sentiment_analysis", 0]}},
+            "first_call_time": {"$first": "$call_time"},
+            "last_call_id": {"$last": "$call_id"},
+            "last_call_time": {"$last": "$call_time"},
+            "last_sentiment_analysis": {"$last": "$sentiment_analysis"},
+        }},
+    ]).to_list(length=1)
+    return {"patient_id": patient_id, **summary[0]} if summary else None
+
+
+async def upload_chat_history_on_mongodb(patient_id: str, call_id: str, new_chats: list, carehome_id: str, sentiment, unsaved_from: int = 0, stored_turns: int = 0):
+    """Turns saved during the call by checkpoint_call aren't written again: `new_chats[unsaved_from:]`
+    go at index `stored_turns` of the saved conversation before the call is marked completed"""
     try:
         logger.info(f"Conversation is: {new_chats}")
 
-        # Create the call entry
-        call_entry = {
-            "call_id": call_id,
-            "call_time": datetime.now(timezone.utc),
-            "sentiment_analysis": sentiment,
-            "conversation": new_chats
-        }
-
-        # Match document by patient ID
-        filter_query = {"patient_id": patient_id}
-
-        # Only set patient_id and carehome_id on insert (not calls!)
-        update_query = {
-            "$setOnInsert": {
-                "patient_id": patient_id,
-                "carehome_id": carehome_id
-            },
-            "$push": {
-                "calls": call_entry
-            }
-        }
-
-        result = await db.chats.update_one(filter_query, update_query, upsert=True)
+        fields = {"sentiment_analysis": sentiment, **conversation_fields(new_chats[unsaved_from:], stored_turns)}
+        await save_call(patient_id, call_id, carehome_id, datetime.now(timezone.utc), fields)
         logger.info("Call uploaded for patient_id: %s, carehome_id: %s", patient_id, carehome_id)
         return True
 
@@ -51,19 +178,13 @@ async def upload_chat_history_on_mongodb(patient_id: str, call_id: str, new_chat
 
 async def upload_on_mongodb(patient_id: str, call_id: str, data_to_upload: dict) -> int:
     """
-    Updates (or creates) a document for the given patient. The document will have:
-      - _id: randomly generated ObjectId (by MongoDB)
+    Saves the call as its own document in `calls` (see save_call):
+      - _id / call_id: the given call_id
       - patient_id: the given patient_id
       - carehome_id: the given carehome_id (from data_to_upload)
-      - calls: an array in which each element is an object with:
-            {
-                "call_id": <call_id>,
-                "human_messages": <messages>,
-                "sentiment_analysis": <sentiment_analysis>
-            }
-    
-    If a document for the given patient_id exists, the function pushes a new call object onto the calls array.
-    Otherwise, it creates a new document with the provided fields.
+      - human_messages, sentiment_analysis, call_time
+
+    Saving the same call_id again replaces its messages and sentiment.
     
     Args:
         patient_id (str): The patient’s identifier.
@@ -74,35 +195,16 @@ async def upload_on_mongodb(patient_id: str, call_id: str, data_to_upload: dict)
             - "carehome_id": the care home identifier.
     
     Returns:
-        int: The number of documents modified.
+        int: 1 once the call is saved (new or replacing an already saved one).
     """
     try:
-        # Filter: find document by patient_id
-        filter_query = {"patient_id": patient_id}
-        
-        # Build the call object to insert
-        new_call = {
-            "call_id": call_id,
+        await save_call(patient_id, call_id, data_to_upload.get("carehome_id"), datetime.now(timezone.utc), {
             "human_messages": data_to_upload.get("human_messages"),
             "sentiment_analysis": data_to_upload.get("sentiment_analysis"),
-            "call_time": datetime.utcnow()
-        }
-        
-        # Update: push new call into the 'calls' array.
-        # $setOnInsert sets patient_id and carehome_id if the document is created.
-        update_query = {
-            "$push": {"calls": new_call},
-            "$setOnInsert": {
-            "patient_id": patient_id,
-            "carehome_id": data_to_upload.get("carehome_id")}}
-
-    
-        # Use upsert=True to create a new document if one does not exist.
-        result = await db.chats.update_one(filter_query, update_query, upsert=True)
+        })
         logger.info("Document updated for patient_id: %s with call_id: %s", patient_id, call_id)
-        return result.modified_count
+        return 1
     except Exception as e:
         print("Error in mongodb service is: ", str(e))
         logger.error("Error in upload_on_mongodb: %s", str(e))
         raise
-
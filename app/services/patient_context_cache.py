@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# Typed patient context for calls
+from schema.patient_context import PatientContext
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class PatientContextCache:
+    """Cache of PatientContext (see services/postgres.py -> get_patient_context) by patient id,
+    so calls of the same patient don't query Postgres again every time.
+
+    - In process (default): LRU in this worker's memory.
+    - Shared (if `shared_path` is given): a local SQLite file that every worker on the
+      host reads and writes, so an invalidation done by one worker is seen by all of them.
+
+    Entries expire after `ttl_seconds`, at most `max_entries` are kept. Whatever changes a
+    patient's data has to call `invalidate(patient_id)` (e.g. when a scheduled call is completed).
+
+    On the event loop use `aget` / `aput` / `ainvalidate`, in shared mode they run the SQLite
+    queries in a worker thread.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int, shared_path: Optional[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.shared_path = shared_path
+
+        self.entries = OrderedDict()        # patient_id -> (PatientContext, stored at)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        if self.shared_path:
+            with self._connect() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS patient_context (patient_id TEXT PRIMARY KEY, data TEXT NOT NULL, stored_at REAL NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS patient_context_stored_at ON patient_context (stored_at)")
+
+    def get(self, patient_id: str) -> Optional[PatientContext]:
+        context = self._get_shared(patient_id) if self.shared_path else self._get_memory(patient_id)
+        with self.lock:
+            if context is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return context
+
+    def put(self, patient_id: str, context: PatientContext):
+        if context is None:
+            return
+        if self.shared_path:
+            self._put_shared(patient_id, context)
+        else:
+            self._put_memory(patient_id, context)
+
+    def get_or_load(self, patient_id: str, loader) -> Optional[PatientContext]:
+        """Cached context or `loader(patient_id)` on a miss (blocking, call it from a worker thread)"""
+        context = self.get(patient_id)
+        if context is None:
+            context = loader(patient_id)
+            self.put(patient_id, context)
+        return context
+
+    def invalidate(self, patient_id: str):
+        with self.lock:
+            self.entries.pop(patient_id, None)
+            self.invalidations += 1
+        if self.shared_path:
+            try:
+                with self._connect() as connection:
+                    connection.execute("DELETE FROM patient_context WHERE patient_id = ?", (patient_id,))
+            except sqlite3.Error as e:
+                logger.error(f"Error while invalidating patient context of {patient_id} -> {str(e)}")
+
+    async def aget(self, patient_id: str) -> Optional[PatientContext]:
+        if self.shared_path:
+            return await asyncio.to_thread(self.get, patient_id)
+        return self.get(patient_id)
+
+    async def aput(self, patient_id: str, context: PatientContext):
+        if self.shared_path:
+            await asyncio.to_thread(self.put, patient_id, context)
+        else:
+            self.put(patient_id, context)
+
+    async def ainvalidate(self, patient_id: str):
+        if self.shared_path:
+            await asyncio.to_thread(self.invalidate, patient_id)
+        else:
+            self.invalidate(patient_id)
+
+    def stats(self) -> dict:
+        entries = len(self.entries)
+        if self.shared_path:
+            try:
+                with self._connect() as connection:
+                    entries = connection.execute("SELECT COUNT(*) FROM patient_context").fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "store": "shared" if self.shared_path else "memory",
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _get_memory(self, patient_id: str) -> Optional[PatientContext]:
+        with self.lock:
+            entry = self.entries.get(patient_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] >= self.ttl_seconds:
+                del self.entries[patient_id]
+                return None
+            self.entries.move_to_end(patient_id)
+            return entry[0]
+
+    def _put_memory(self, patient_id: str, context: PatientContext):
+        with self.lock:
+            self.entries[patient_id] = (context, time.monotonic())
+            self.entries.move_to_end(patient_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _connect(self):
+        # One connection per operation, they are used from many worker threads
+        return sqlite3.connect(self.shared_path, timeout=5)
+
+    def _get_shared(self, patient_id: str) -> Optional[PatientContext]:
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT data FROM patient_context WHERE patient_id = ? AND stored_at > ?",
+                    (patient_id, time.time() - self.ttl_seconds),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error while reading patient context cache -> {str(e)}")
+            return None
+        return PatientContext.model_validate_json(row[0]) if row else None
+
+    def _put_shared(self, patient_id: str, context: PatientContext):
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO patient_context (patient_id, data, stored_at) VALUES (?, ?, ?)",
+                    (patient_id, context.model_dump_json(), time.time()),
+                )
+                # Expired entries and everything over the size limit, oldest first
+                connection.execute(
+                    "DELETE FROM patient_context WHERE stored_at <= ? OR patient_id NOT IN "
+                    "(SELECT patient_id FROM patient_context ORDER BY stored_at DESC LIMIT ?)",
+                    (time.time() - self.ttl_seconds, self.max_entries),
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error while writing patient context cache -> {str(e)}")
+
+
+# In process by default, PATIENT_CONTEXT_CACHE_PATH (a local file) shares it between workers
+patient_context_cache = PatientContextCache(
+    ttl_seconds=float(os.getenv("PATIENT_CONTEXT_CACHE_TTL_SECONDS", "300")),
+    max_entries=int(os.getenv("PATIENT_CONTEXT_CACHE_MAX_ENTRIES", "2000")),
+    shared_path=os.getenv("PATIENT_CONTEXT_CACHE_PATH"),
+)
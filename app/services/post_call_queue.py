@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class PostCallQueue:
+    """Work to do after a call ends (sentiment, saving the transcript, status update, safety
+    checks), out of the websocket handler.
+
+    Jobs are kept in a local SQLite spool until every step is done, so they survive a crash
+    or a restart, and every uvicorn worker on the host can use the same spool file:
+    - One job per call id, enqueueing the same call again (a reconnect) updates its payload and
+      runs the steps again, except the "retry": False ones that already ran. A job that is
+      running isn't touched, it is marked to run again once the current attempt is over.
+    - `steps` run in order, a finished step is recorded and not run again on a retry.
+      A step is (name, async function(job, results)) or (name, function, options):
+      "timeout": False runs it without `step_timeout`, "retry": False records it before it
+      runs so a retry never runs it again (e.g. an email that must not go out twice).
+    - A failed job is retried after `retry_seconds` (doubling every attempt), after
+      `max_attempts` it is kept as failed for someone to look at.
+    - A worker holds a job for `lease_seconds`, if it dies the job is picked up again after that.
+    - At most `workers` jobs run at the same time in this process.
+    """
+
+    def __init__(self, path: str, steps: list, workers: int = 2, max_attempts: int = 5, retry_seconds: float = 5,
+                 lease_seconds: float = 300, step_timeout: float = 60, poll_seconds: float = 2):
+        self.path = path
+        self.steps = steps                  # [(name, async function(job, results) -> result[, options])]
+        # Results kept when a call is enqueued again, these steps never run twice
+        self.once_steps = [name for name, _, *options in steps if options and not options[0].get("retry", True)]
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.lease_seconds = lease_seconds
+        self.step_timeout = step_timeout
+        self.poll_seconds = poll_seconds
+
+        self.tasks = []
+        self.wakeup = None
+        self.processed = 0
+        self.retries = 0
+        self.failures = 0
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS post_call_jobs ("
+                "call_id TEXT PRIMARY KEY, payload TEXT NOT NULL, results TEXT NOT NULL DEFAULT '{}', "
+                "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL, last_error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS post_call_jobs_due ON post_call_jobs (status, next_attempt_at)")
+            # Spools created before jobs could be marked to run again
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(post_call_jobs)")]
+            if "rerun" not in columns:
+                connection.execute("ALTER TABLE post_call_jobs ADD COLUMN rerun INTEGER NOT NULL DEFAULT 0")
+
+    def start(self):
+        """Starts the workers (needs a running event loop), they also pick up the jobs left in the spool"""
+        if self.tasks:
+            return
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        """Stops the workers, a job they were running stays in the spool and is retried after its lease"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def enqueue(self, call_id: str, payload: dict):
+        """Saves the job in the spool (so it isn't lost even if the process dies right after) and
+        wakes up a worker. A call that reconnected and ended again gets its newer payload, the
+        steps run again for it"""
+        await asyncio.to_thread(self._save, str(call_id), json.dumps(payload, default=str))
+        self.start()
+        self.wakeup.set()
+
+    def stats(self) -> dict:
+        try:
+            with self._connect() as connection:
+                counts = dict(connection.execute("SELECT status, COUNT(*) FROM post_call_jobs GROUP BY status").fetchall())
+        except sqlite3.Error:
+            counts = None
+        return {
+            "workers": len(self.tasks),
+            "jobs": counts,
+            "processed": self.processed,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+    def _connect(self):
+        # One connection per operation, they are used from many worker threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _rerun_results(self, results: str) -> str:
+        """Results a job starts again with: only the steps that must not run twice"""
+        results = json.loads(results)
+        return json.dumps({name: results[name] for name in self.once_steps if name in results}, default=str)
+
+    def _save(self, call_id: str, payload: str):
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT status, results FROM post_call_jobs WHERE call_id = ?", (call_id,)).fetchone()
+            if row is None:
+                connection.execute(
+                    "INSERT INTO post_call_jobs (call_id, payload, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (call_id, payload, now, now, now),
+                )
+            elif row[0] == "running":
+                # A worker has it, it runs again with this payload after that attempt (see _finish)
+                connection.execute(
+                    "UPDATE post_call_jobs SET payload = ?, rerun = 1, updated_at = ? WHERE call_id = ?",
+                    (payload, now, call_id),
+                )
+            else:
+                connection.execute(
+                    "UPDATE post_call_jobs SET payload = ?, results = ?, status = 'pending', attempts = 0, rerun = 0, "
+                    "next_attempt_at = ?, last_error = NULL, updated_at = ? WHERE call_id = ?",
+                    (payload, self._rerun_results(row[1]), now, now, call_id),
+                )
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _claim(self) -> Optional[tuple]:
+        """Next due job (or one whose worker's lease ran out), marked as running by this worker"""
+        now = time.time()
+        connection = self._connect()
+        try:
+            # IMMEDIATE takes the write lock first, so two processes can't claim the same job
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT call_id, payload, results, attempts FROM post_call_jobs "
+                "WHERE status IN ('pending', 'running') AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE post_call_jobs SET status = 'running', attempts = attempts + 1, next_attempt_at = ?, updated_at = ? WHERE call_id = ?",
+                    (now + self.lease_seconds, now, row[0]),
+                )
+            connection.commit()
+            return row
+        finally:
+            connection.close()
+
+    def _save_results(self, call_id: str, results: dict):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE post_call_jobs SET results = ?, updated_at = ? WHERE call_id = ? AND status = 'running'",
+                (json.dumps(results, default=str), time.time(), call_id),
+            )
+
+    def _finish(self, call_id: str, status: str, next_attempt_at: float = 0, error: str = None) -> bool:
+        """Ends the attempt, returns True if the call was enqueued again meanwhile and the job
+        is back to pending with the new payload"""
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT results, rerun FROM post_call_jobs WHERE call_id = ? AND status = 'running'", (call_id,)
+            ).fetchone()
+            rerun = row is not None and bool(row[1])
+            if rerun:
+                connection.execute(
+                    "UPDATE post_call_jobs SET results = ?, status = 'pending', attempts = 0, rerun = 0, "
+                    "next_attempt_at = ?, last_error = NULL, updated_at = ? WHERE call_id = ?",
+                    (self._rerun_results(row[0]), now, now, call_id),
+                )
+            elif row is not None:
+                connection.execute(
+                    "UPDATE post_call_jobs SET status = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE call_id = ?",
+                    (status, next_attempt_at, error, now, call_id),
+                )
+            connection.commit()
+            return rerun
+        finally:
+            connection.close()
+
+    async def _worker(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                job = await asyncio.to_thread(self._claim)
+            except sqlite3.Error as e:
+                logger.error(f"Error while reading the post call spool -> {str(e)}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(*job)
+
+    async def _run(self, call_id: str, payload: str, results: str, attempts: int):
+        job = json.loads(payload)
+        results = json.loads(results)
+        attempt = attempts + 1
+        try:
+            for name, step, *options in self.steps:
+                options = options[0] if options else {}
+                if name in results:
+                    continue
+                if not options.get("retry", True):
+                    # Saved as attempted first: if it fails halfway it isn't run again
+                    results[name] = None
+                    await asyncio.to_thread(self._save_results, call_id, results)
+                if options.get("timeout", True):
+                    results[name] = await asyncio.wait_for(step(job, results), self.step_timeout)
+                else:
+                    results[name] = await step(job, results)
+                await asyncio.to_thread(self._save_results, call_id, results)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            if attempt >= self.max_attempts:
+                self.failures += 1
+                logger.error(f"Post call job of call {call_id} failed {attempt} times, giving up -> {error}")
+                await asyncio.to_thread(self._finish, call_id, "failed", 0, error)
+            else:
+                self.retries += 1
+                delay = self.retry_seconds * 2 ** (attempt - 1)
+                logger.warning(f"Post call job of call {call_id} failed (attempt {attempt}), retrying in {delay}s -> {error}")
+                await asyncio.to_thread(self._finish, call_id, "pending", time.time() + delay, error)
+            return
+
+        self.processed += 1
+        if await asyncio.to_thread(self._finish, call_id, "done"):
+            logger.info(f"Post call job of call {call_id} done, running it again for the reconnected call")
+        else:
+            logger.info(f"Post call job of call {call_id} done")
+
+
+def create_post_call_queue() -> PostCallQueue:
+    # Steps live with the rest of the after call work
+    from services.after_call_ends import POST_CALL_STEPS
+
+    return PostCallQueue(
+        os.getenv("POST_CALL_SPOOL_PATH", "post_call_spool.sqlite3"),
+        POST_CALL_STEPS,
+        workers=int(os.getenv("POST_CALL_WORKERS", "2")),
+        max_attempts=int(os.getenv("POST_CALL_MAX_ATTEMPTS", "5")),
+        retry_seconds=float(os.getenv("POST_CALL_RETRY_SECONDS", "5")),
+        lease_seconds=float(os.getenv("POST_CALL_LEASE_SECONDS", "300")),
+        step_timeout=float(os.getenv("POST_CALL_STEP_TIMEOUT_SECONDS", "60")),
+    )
+
+
+post_call_queue = create_post_call_queue()
@@ -9,10 +9,17 @@ from model.care_home import CareHome
 from model.demo_access import DemoAccess
 
 # For getting postgresql db 
-from db.postgres import get_db
+from db.postgres import session_scope, async_session_scope
+from sqlalchemy import select, update
+
+# Typed patient context for calls
+from schema.patient_context import PatientContext
+
+# Cached patient contexts, invalidated here when their data changes
+from services.patient_context_cache import patient_context_cache
 
 # To check the 48 hours access of demo user
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
 import logging 
 logger = logging.getLogger(__name__)
@@ -30,9 +37,9 @@ def get_carehome_id_from_patient_id(patient_id: str) -> str:
     :return: The carehome_id for the patient, or None if the patient does not exist.
     """
     try:
-        db = next(get_db()) 
-        patient = db.query(Patient).filter(Patient.id == patient_id).first()
-        return patient.carehome_id if patient else None
+        with session_scope() as db:
+            patient = db.query(Patient).filter(Patient.id == patient_id).first()
+            return patient.carehome_id if patient else None
     except Exception as e: 
         print("Error in postgres.py in services: ",str(e))
         raise
@@ -50,10 +57,10 @@ def get_patient_medical_summary_from_patient_id(patient_id :str) ->str:
         - patient_medical_history_summary(str)
     """
     try:
-        db =next(get_db()) 
-        patient_medical_history_summary = db.query(Summary).filter(Summary.patient_id == patient_id).first()
-        print("Patient medical history summary is: ",patient_medical_history_summary.content)
-        return patient_medical_history_summary.content if patient_medical_history_summary else None
+        with session_scope() as db:
+            patient_medical_history_summary = db.query(Summary).filter(Summary.patient_id == patient_id).first()
+            print("Patient medical history summary is: ",patient_medical_history_summary.content)
+            return patient_medical_history_summary.content if patient_medical_history_summary else None
     except Exception as e:
         print("Error in get_patient_summary_from_patient_id function inside postgres in services -> ",str(e))
         raise
@@ -67,12 +74,12 @@ def get_patient_life_history(patient_id:str) -> str:
     OUTPUT:
         - patient life history(str)"""
     try:
-        db = next(get_db()) 
-        patient_life_history = db.query(LifeHistory).filter(LifeHistory.patient_id == patient_id).first()
-        # print("Patient life history added by the family is: ",patient_life_history.history)
-        if(patient_life_history is None):
-            return False
-        return patient_life_history.history if patient_life_history else None
+        with session_scope() as db:
+            patient_life_history = db.query(LifeHistory).filter(LifeHistory.patient_id == patient_id).first()
+            # print("Patient life history added by the family is: ",patient_life_history.history)
+            if(patient_life_history is None):
+                return False
+            return patient_life_history.history if patient_life_history else None
     
     except Exception as e:
         print("Error in get_patient_life_history function inside postgres in services -> ",str(e))
@@ -87,19 +94,90 @@ def get_current_call_title_description(patient_id: str) ->str:
         - title (str)
         - what_to_talk (what to talk about in the call)"""
     try:
-        db = next(get_db())
-        what_to_talk = db.query(ScheduledCall).filter(ScheduledCall.patient_id == patient_id,ScheduledCall.status == 'scheduled').first()
+        with session_scope() as db:
+            what_to_talk = db.query(ScheduledCall).filter(ScheduledCall.patient_id == patient_id,ScheduledCall.status == 'scheduled').first()
 
-        if what_to_talk is None:
-            return " ", " "
-        # print("What to talk about in the call: ",what_to_talk.title, " and its description is: ",what_to_talk.description)
-        return what_to_talk.title, what_to_talk.description
+            if what_to_talk is None:
+                return " ", " "
+            # print("What to talk about in the call: ",what_to_talk.title, " and its description is: ",what_to_talk.description)
+            return what_to_talk.title, what_to_talk.description
     except Exception as e:
         print("Error in get_current_call_title_description inside postgres in services -> ",str(e))
         raise      
 
 
 
+# Columns of the joined patient context query, in the order patient_context_from_row reads them
+PATIENT_CONTEXT_COLUMNS = (
+    Patient.first_name,
+    Patient.carehome_id,
+    Patient.hume_voice,
+    Summary.content,
+    LifeHistory.history,
+    ScheduledCall.id,
+    ScheduledCall.call_duration,
+    ScheduledCall.title,
+    ScheduledCall.description,
+)
+
+
+# The joins can match several rows: the soonest scheduled call, the latest life history and summary
+PATIENT_CONTEXT_ORDER = (
+    ScheduledCall.call_time.asc().nulls_last(),
+    LifeHistory.updated_at.desc().nulls_last(),
+    Summary.created_at.desc().nulls_last(),
+)
+
+
+def patient_context_from_row(patient_id: str, row) -> PatientContext:
+    if row is None:
+        return None
+    first_name, carehome_id, voice, medical_summary, life_history, schedule_id, call_duration, title, description = row
+    return PatientContext(
+        patient_id=patient_id,
+        first_name=first_name,
+        carehome_id=carehome_id,
+        voice=voice,
+        medical_summary=medical_summary,
+        life_history=life_history if life_history is not None else False,
+        schedule_id=schedule_id,
+        call_duration=call_duration,
+        title=title if schedule_id is not None else " ",
+        description=description if schedule_id is not None else " ",
+    )
+
+
+def get_patient_context(patient_id: str) -> PatientContext:
+    """Patient details, medical summary, life history and the active scheduled call in one
+    joined query (instead of one round trip each), used by prepare_prompt and get-data-before-call
+    INPUT:
+        - patient_id
+    OUTPUT:
+        - PatientContext, None if the patient doesn't exist"""
+    try:
+        with session_scope() as db:
+            row = (
+                db.query(*PATIENT_CONTEXT_COLUMNS)
+                .outerjoin(Summary, Summary.patient_id == Patient.id)
+                .outerjoin(LifeHistory, LifeHistory.patient_id == Patient.id)
+                .outerjoin(ScheduledCall, (ScheduledCall.patient_id == Patient.id) & (ScheduledCall.status == "scheduled"))
+                .filter(Patient.id == patient_id)
+                .order_by(*PATIENT_CONTEXT_ORDER)
+                .first()
+            )
+        return patient_context_from_row(patient_id, row)
+    except Exception as e:
+        print("Error in get_patient_context function inside postgres in services -> ",str(e))
+        raise
+
+
+
+def get_cached_patient_context(patient_id: str) -> PatientContext:
+    """get_patient_context through the patient context cache (only queries on a miss)"""
+    return patient_context_cache.get_or_load(patient_id, get_patient_context)
+
+
+
 def did_change_status_to_completed(patient_id:str)->str:
     """This function gets called when a scheduled call ends and now we have to change its status
     INPUT:
@@ -109,16 +187,18 @@ def did_change_status_to_completed(patient_id:str)->str:
         - True
         - If there is a problem an Error will be raised (raise)""" 
     try:
-        db = next(get_db())
-        status_change = db.query(ScheduledCall).filter(
-                        ScheduledCall.patient_id == patient_id,
-                        ScheduledCall.status == "scheduled").update({"status": "completed"}, synchronize_session=False)
-        if status_change != 1:
-            print('Critical error')
-            print(status_change)
+        with session_scope() as db:
+            status_change = db.query(ScheduledCall).filter(
+                            ScheduledCall.patient_id == patient_id,
+                            ScheduledCall.status == "scheduled").update({"status": "completed"}, synchronize_session=False)
+            if status_change != 1:
+                print('Critical error')
+                print(status_change)
             
-        db.commit()
-        return True
+            db.commit()
+            # The active scheduled call is part of the cached context
+            patient_context_cache.invalidate(patient_id)
+            return True
     except Exception as e:
         print("Error in postgres while changing status -> ",str(e))
         raise
@@ -127,18 +207,18 @@ def did_change_status_to_completed(patient_id:str)->str:
 def get_time_from_schedule_call_using_patient_id(schedule_id):
     """Get time of scheduled call in seconds"""
     try:
-        db= next(get_db())
-        time = (db.query(ScheduledCall.call_duration).filter(ScheduledCall.id == schedule_id).first())
-        if time is None:
-            raise HTTPException(status_code=404, detail="No call with this schedule id found")
+        with session_scope() as db:
+            time = (db.query(ScheduledCall.call_duration).filter(ScheduledCall.id == schedule_id).first())
+            if time is None:
+                raise HTTPException(status_code=404, detail="No call with this schedule id found")
         
-        call_duration = time[0] if time else False
+            call_duration = time[0] if time else False
 
-        if call_duration:
-            return call_duration
-        else:
-            logger.error("Call duration is none that's what the db sent")
-            raise HTTPException(status_code=500, detail="No call with this schedule id found")
+            if call_duration:
+                return call_duration
+            else:
+                logger.error("Call duration is none that's what the db sent")
+                raise HTTPException(status_code=500, detail="No call with this schedule id found")
         
     except HTTPException as he:
         raise he
@@ -152,10 +232,10 @@ def get_carehome_email(patient_id):
     """To get carehome email from patient_id. This is so we can send carehome email,
         when user show suicidal thoughts"""
     try:
-        db = next(get_db())
-        carehome_email = db.query(CareHome.email) .join(Patient, CareHome.id == Patient.carehome_id).filter(Patient.id == patient_id).scalar()
-        print("carehome email is: ",carehome_email)
-        return carehome_email
+        with session_scope() as db:
+            carehome_email = db.query(CareHome.email) .join(Patient, CareHome.id == Patient.carehome_id).filter(Patient.id == patient_id).scalar()
+            print("carehome email is: ",carehome_email)
+            return carehome_email
     except Exception as e:
         print("Error while getiitng carehome email in -> get_carehome_email function in postgres",str(e))
     
@@ -164,33 +244,33 @@ def get_carehome_email(patient_id):
 def create_new_demo_access(email, name, phone_number):
     """To create demo access in postgress"""
     try:
-        db = next(get_db())
-        new_user = DemoAccess(
-        name=name,
-        email=email,
-        phone_number=phone_number, remaining_time = 1800)
-        db.add(new_user)
-        db.commit()
-        return True
+        with session_scope() as db:
+            new_user = DemoAccess(
+            name=name,
+            email=email,
+            phone_number=phone_number, remaining_time = 1800)
+            db.add(new_user)
+            db.commit()
+            return True
     except Exception as e:
         print("Error on database is: ",str(e))
         raise HTTPException(status_code=500, detail="Error while creating user")
 
 def validate_user(user_email: str):
     try:
-        db = next(get_db())
-        user = db.query(DemoAccess).filter(DemoAccess.email == user_email).first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found, please register first")
-        if user is not None:
-            if user.access is False:
-                raise HTTPException(status_code=403, detail="Your request hasn't been accepted yet by the admin.")
-
-            current_time = datetime.now(timezone.utc)
-            if current_time > user.access_upto:
-                raise HTTPException(status_code=403, detail="Access expired.")
-
-            return True
+        with session_scope() as db:
+            user = db.query(DemoAccess).filter(DemoAccess.email == user_email).first()
+            if user is None:
+                raise HTTPException(status_code=404, detail="User not found, please register first")
+            if user is not None:
+                if user.access is False:
+                    raise HTTPException(status_code=403, detail="Your request hasn't been accepted yet by the admin.")
+
+                current_time = datetime.now(timezone.utc)
+                if current_time > user.access_upto:
+                    raise HTTPException(status_code=403, detail="Access expired.")
+
+                return True
     except HTTPException as he:
         # Propagate HTTPException without modification.
         raise he
@@ -207,12 +287,12 @@ def does_user_exist(email: str):
         - False: if user doesn't exist
         - True: if user does exist"""
     try:
-        db = next(get_db())
-        does_exist = db.query(DemoAccess).filter(DemoAccess.email == email).first()
-        if does_exist is None:
-            return False
-        else:
-            return True
+        with session_scope() as db:
+            does_exist = db.query(DemoAccess).filter(DemoAccess.email == email).first()
+            if does_exist is None:
+                return False
+            else:
+                return True
         
     except Exception as e:
         print("Error in does user exist: ",str(e))
@@ -224,16 +304,16 @@ def does_user_exist(email: str):
 
 def grant_access_by_email(email: str):
     """TO give access to user, this function will put True in False's place in access column of demo user"""
-    db = next(get_db())
-    user = db.query(DemoAccess).filter(DemoAccess.email == email, DemoAccess.access == False).first()
+    with session_scope() as db:
+        user = db.query(DemoAccess).filter(DemoAccess.email == email, DemoAccess.access == False).first()
     
-    if user:
-        user.access = True  # Update the access field
-        db.commit()  # Commit the changes
-        db.refresh(user)  # Refresh the session
-        return True  # Return the updated user object
-    else:
-        return False
+        if user:
+            user.access = True  # Update the access field
+            db.commit()  # Commit the changes
+            db.refresh(user)  # Refresh the session
+            return True  # Return the updated user object
+        else:
+            return False
     
 
 
@@ -281,11 +361,11 @@ def is_user_eligible_for_call(db, email: str):
 
 def delete_user_from_db(email: str):
     try:
-        db = next(get_db())
-        user = db.query(DemoAccess).filter(DemoAccess.email == email).first()
-        db.delete(user)
-        db.commit()
-        return True
+        with session_scope() as db:
+            user = db.query(DemoAccess).filter(DemoAccess.email == email).first()
+            db.delete(user)
+            db.commit()
+            return True
     except Exception as e:
         print("Error in deleting user from db: ",str(e))
         raise HTTPException(status_code=500, detail="An Error has occured while deleting user from db")
@@ -293,11 +373,11 @@ def delete_user_from_db(email: str):
 def add_demo_history(email: str, name: str, phone_number: str):
     """To add email to the demo history table"""
     try:
-        db = next(get_db())
-        new_history = DemoHistory(email=email, name =name , phone_number = phone_number)
-        db.add(new_history)
-        db.commit()
-        return True
+        with session_scope() as db:
+            new_history = DemoHistory(email=email, name =name , phone_number = phone_number)
+            db.add(new_history)
+            db.commit()
+            return True
     except Exception as e:
         print("Error in adding demo history: ",str(e))
         raise HTTPException(status_code=500, detail="An Error has occured while adding demo history")
@@ -305,14 +385,14 @@ def add_demo_history(email: str, name: str, phone_number: str):
 # Service to give access to user
 def give_access_to_user_by_admin(email: str):
     try:
-        db = next(get_db())
-        user = db.query(DemoAccess).filter(DemoAccess.email == email).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        user.access = True
-        db.commit()
-        db.refresh(user)
-        return True
+        with session_scope() as db:
+            user = db.query(DemoAccess).filter(DemoAccess.email == email).first()
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            user.access = True
+            db.commit()
+            db.refresh(user)
+            return True
     except Exception as e:
         print("Error in giving access to user by admin: ",str(e))
         raise HTTPException(status_code=500, detail="An Error has occured while giving access to user by admin")
@@ -322,11 +402,11 @@ def give_access_to_user_by_admin(email: str):
 def get_demo_user_by_email(email: str):
     """To get all the details of the demo user using its email"""
     try:
-        db= next(get_db())
-        user = db.query(DemoAccess).filter(DemoAccess.email == email).first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-        return user
+        with session_scope() as db:
+            user = db.query(DemoAccess).filter(DemoAccess.email == email).first()
+            if user is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            return user
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -336,23 +416,23 @@ def get_demo_user_by_email(email: str):
     
 def get_voice_from_db(patient_id):
     """To get voice from the db"""
-    db = next(get_db())
-    user = db.query(Patient).filter(Patient.id == patient_id).first()
-    if user is None:
-        raise HTTPException(status_code=404, detail="User with this user id not found")
-    if user:
-        return user.hume_voice
-    else:
-        False
+    with session_scope() as db:
+        user = db.query(Patient).filter(Patient.id == patient_id).first()
+        if user is None:
+            raise HTTPException(status_code=404, detail="User with this user id not found")
+        if user:
+            return user.hume_voice
+        else:
+            False
         
         
 def get_first_name_of_patient(patient_id):
-    db = next(get_db())
-    user = db.query(Patient).filter(Patient.id == patient_id).first()
-    if user:
-        return user.first_name
-    else:                
-        False
+    with session_scope() as db:
+        user = db.query(Patient).filter(Patient.id == patient_id).first()
+        if user:
+            return user.first_name
+        else:                
+            False
 
 
 def get_patient_id_from_schedule_id(db, schedule_id: str):
@@ -372,4 +452,199 @@ def get_patient_phone_number(db, patient_id):
     if user:
         return user.phone_number
     else:                
-        False
\ No newline at end of file
+        False
+
+
+
+
+# Async versions of the queries used by async routes (websockets, pre-call endpoint...),
+# they don't block the event loop that every live call on the worker runs on
+
+async def aget_patient_context(patient_id: str) -> PatientContext:
+    """Async version of get_patient_context"""
+    try:
+        async with async_session_scope() as db:
+            result = await db.execute(
+                select(*PATIENT_CONTEXT_COLUMNS)
+                .outerjoin(Summary, Summary.patient_id == Patient.id)
+                .outerjoin(LifeHistory, LifeHistory.patient_id == Patient.id)
+                .outerjoin(ScheduledCall, (ScheduledCall.patient_id == Patient.id) & (ScheduledCall.status == "scheduled"))
+                .where(Patient.id == patient_id)
+                .order_by(*PATIENT_CONTEXT_ORDER)
+                .limit(1)
+            )
+            row = result.first()
+        return patient_context_from_row(patient_id, row)
+    except Exception as e:
+        print("Error in aget_patient_context function inside postgres in services -> ",str(e))
+        raise
+
+
+async def aget_cached_patient_context(patient_id: str) -> PatientContext:
+    """Async version of get_cached_patient_context"""
+    context = await patient_context_cache.aget(patient_id)
+    if context is None:
+        context = await aget_patient_context(patient_id)
+        await patient_context_cache.aput(patient_id, context)
+    return context
+
+
+async def aget_time_from_schedule_call_using_patient_id(schedule_id):
+    """Async version of get_time_from_schedule_call_using_patient_id"""
+    try:
+        async with async_session_scope() as db:
+            result = await db.execute(select(ScheduledCall.call_duration).where(ScheduledCall.id == schedule_id))
+            time = result.first()
+        if time is None:
+            raise HTTPException(status_code=404, detail="No call with this schedule id found")
+
+        call_duration = time[0]
+        if call_duration:
+            return call_duration
+        else:
+            logger.error("Call duration is none that's what the db sent")
+            raise HTTPException(status_code=500, detail="No call with this schedule id found")
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.exception(f"Error on aget_time_from_schedule_call_using_patient_id in postgres.py -> {str(e)}")
+        raise HTTPException(status_code=500, detail="Error in db")
+
+
+async def aget_pre_call_data(schedule_ids: list = None, carehome_id: str = None, start: datetime = None, end: datetime = None) -> list:
+    """What get-data-before-call returns (without warming up a session) for many scheduled calls
+    at once, in one query whatever the number of calls
+    INPUT:
+        - schedule_ids, or
+        - carehome_id with the window of call_time (start inclusive, end exclusive)
+    OUTPUT:
+        - One dict per scheduled call found, ordered by call_time"""
+    query = (
+        select(
+            ScheduledCall.id,
+            ScheduledCall.patient_id,
+            ScheduledCall.call_time,
+            ScheduledCall.call_duration,
+            ScheduledCall.status,
+            Patient.first_name,
+            Patient.carehome_id,
+            Patient.hume_voice,
+        )
+        .join(Patient, Patient.id == ScheduledCall.patient_id)
+        .order_by(ScheduledCall.call_time)
+    )
+    if schedule_ids is not None:
+        query = query.where(ScheduledCall.id.in_(schedule_ids))
+    else:
+        # call_time is stored as naive UTC
+        start = to_naive_utc(start) if start else datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+        end = to_naive_utc(end) if end else start + timedelta(days=1)
+        query = query.where(Patient.carehome_id == carehome_id, ScheduledCall.call_time >= start, ScheduledCall.call_time < end)
+
+    try:
+        async with async_session_scope() as db:
+            rows = (await db.execute(query)).all()
+    except Exception as e:
+        logger.exception(f"Error on aget_pre_call_data in postgres.py -> {str(e)}")
+        raise HTTPException(status_code=500, detail="Error in db")
+
+    return [
+        {
+            "schedule_id": schedule_id,
+            "patient_id": patient_id,
+            "call_time": call_time,
+            "call_duration": call_duration,
+            "status": status,
+            "patient_first_name": first_name,
+            "carehome_id": patient_carehome_id,
+            "voice": voice,
+        }
+        for schedule_id, patient_id, call_time, call_duration, status, first_name, patient_carehome_id, voice in rows
+    ]
+
+
+def to_naive_utc(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def adid_change_status_to_completed(patient_id: str, schedule_id: str):
+    """Async version of did_change_status_to_completed, for the scheduled call `schedule_id`
+    only (the post call job can run late or again, the patient may have a newer call by then)"""
+    try:
+        async with async_session_scope() as db:
+            result = await db.execute(
+                update(ScheduledCall)
+                .where(ScheduledCall.id == schedule_id, ScheduledCall.patient_id == patient_id, ScheduledCall.status == "scheduled")
+                .values(status="completed")
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                logger.warning(f"Scheduled call {schedule_id} of patient {patient_id} wasn't scheduled anymore ({result.rowcount} rows updated)")
+            await db.commit()
+        # The active scheduled call is part of the cached context
+        await patient_context_cache.ainvalidate(patient_id)
+        return True
+    except Exception as e:
+        print("Error in postgres while changing status -> ",str(e))
+        raise
+
+
+async def aget_patient_id_from_schedule_id(schedule_id: str):
+    """Async version of get_patient_id_from_schedule_id"""
+    try:
+        async with async_session_scope() as db:
+            result = await db.execute(select(ScheduledCall.patient_id).where(ScheduledCall.id == schedule_id))
+            patient_id = result.scalar()
+        return patient_id if patient_id is not None else False
+    except Exception as e:
+        logger.exception(f"Error on aget_patient_id_from_schedule_id in postgres.py -> {str(e)}")
+        raise HTTPException(status_code=500, detail="An error occurred while getting patient ID from schedule ID")
+
+
+async def aget_patient_phone_number(patient_id):
+    """Async version of get_patient_phone_number"""
+    async with async_session_scope() as db:
+        result = await db.execute(select(Patient.phone_number).where(Patient.id == patient_id))
+        return result.scalar()
+
+
+async def ais_user_eligible_for_call(email: str):
+    """Async version of is_user_eligible_for_call, with its own session"""
+    try:
+        async with async_session_scope() as db:
+            user = (await db.execute(select(DemoAccess).where(DemoAccess.email == email))).scalars().first()
+
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        if user.access:
+            if user.remaining_time >= 1:
+                return True, user.remaining_time
+            else:
+                return False, 0
+        else:
+            raise HTTPException(status_code=400, detail="User doesn't have access")
+
+    except HTTPException as hp:
+        raise hp
+    except Exception as e:
+        print("Error in eligibility is: ",str(e))
+        raise HTTPException(status_code=500, detail="An Error has occured while checking eligibility")
+
+
+async def agive_access_to_user_by_admin(email: str):
+    """Async version of give_access_to_user_by_admin"""
+    try:
+        async with async_session_scope() as db:
+            user = (await db.execute(select(DemoAccess).where(DemoAccess.email == email))).scalars().first()
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            user.access = True
+            await db.commit()
+        return True
+    except Exception as e:
+        print("Error in giving access to user by admin: ",str(e))
+        raise HTTPException(status_code=500, detail="An Error has occured while giving access to user by admin")
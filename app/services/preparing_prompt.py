@@ -1,21 +1,65 @@
 # importing required functions to query postgresql
-from services.postgres import get_patient_life_history, get_patient_medical_summary_from_patient_id, get_current_call_title_description
+from services.postgres import get_cached_patient_context
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# PROMPT_LAYOUT=stable_first orders the prompt from what never changes to what changes every call
+# (persona rules -> patient summary -> life history -> today's topic), so the LLM provider can
+# reuse its cached prefix across turns and calls. Anything else keeps the original layout.
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "legacy").lower()
+
+PERSONA_RULES = """Your name is Elys, You have 10 years of therapist experience and you have been helping patients with dimentia for 7 years now.
+      1. You are going to do therapy session with a patient who is in a carehome.
+      2. All responses must be exclusively in English. If user says he wants to talk in another language, politely say you don't know any other language.
+      3. Engage through reminiscence & open-ended sentences.
+      4. Tell user stories from his past (use user's life history below for this) or encourage user to share stories tied to his past.
+      5. Anchor discussions in familiar joys.
+      6. Use NLP techniques & therapeutic storytelling.
+      7. If user becomes confused or disengaged, gently redirect the conversation:
+          "That’s okay, Let’s talk about something else."
+      8. Use only verified information."""
+
+
+def build_stable_first_prompt(medical_summary, life_history, title, description):
+    """Same content as the legacy prompt, most stable part first (the conversation history
+    and its summary always come after the system prompt)"""
+    return f"""{PERSONA_RULES}
+
+User personal details and medical details are: {medical_summary}
+
+User life history is: {life_history}. Now use this to tell stories to the user about his/her life, like what he did in his/her life.
+
+During this interaction, focus primarily on: {title}. Details are as follows: {description}."""
 
 
 def prepare_prompt(patient_id):
     """We will pass patient id to functions that will query the postgreq db.
     The data we get, we will prepare starting prompt with that."""
+    return prepare_prompt_from_context(get_cached_patient_context(patient_id))
+
+
+def prepare_prompt_from_context(context):
+    """Same as prepare_prompt, for a PatientContext that was already loaded"""
     try:
-        life_history = get_patient_life_history(patient_id)
+        if context is None:
+            return " "
+        life_history = context.life_history
         print("Life history is: ", life_history)
-        medical_summary = get_patient_medical_summary_from_patient_id(patient_id)
+        medical_summary = context.medical_summary
         print("Medical history is: ",medical_summary)
-        title, description= get_current_call_title_description(patient_id)
+        title, description = context.title, context.description
         print("Title is: ", title, " description is: ", description)
         if medical_summary is None:
             return " "
         
-        instruction = f"""Your name is Elys, You have 10 years of therapist experience and you have been helping patients with dimentia for 7 years now.
+        if PROMPT_LAYOUT == "stable_first":
+            instruction = build_stable_first_prompt(medical_summary, life_history, title, description)
+        else:
+            instruction = f"""Your name is Elys, You have 10 years of therapist experience and you have been helping patients with dimentia for 7 years now.
       1.  You are going to do therapy session with a patient who is in a carehome:
       2. All responses must be exclusively in English. If user says he wants to talk in another language, politely say you don't know any other language.
       3. User personal details and medical details are: {medical_summary}
@@ -0,0 +1,80 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from string import Formatter
+
+from dotenv import load_dotenv
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# The only variable a system prompt may use, filled with the user's message
+TEMPLATE_VARIABLES = {"user_input"}
+
+
+def compile_system_prompt(prompt_text: str):
+    """Turns the prompt text into what generate_chat_prompt renders the system prompt from:
+        - SystemMessage: the prompt has no variables, so it is already rendered
+        - ChatPromptTemplate: the prompt uses {user_input}
+
+    Braces that aren't a known variable (e.g. in a life history) are kept as plain text
+    instead of breaking the f-string template."""
+    try:
+        variables = {name for _, name, _, _ in Formatter().parse(prompt_text) if name is not None}
+    except ValueError:
+        # Unbalanced braces, can't be a template
+        return SystemMessage(prompt_text)
+
+    if not variables:
+        # Same result the f-string template gave ({{ and }} become single braces)
+        return SystemMessage(prompt_text.format())
+    if not variables <= TEMPLATE_VARIABLES:
+        return SystemMessage(prompt_text)
+    return ChatPromptTemplate.from_messages([SystemMessagePromptTemplate.from_template(prompt_text)])
+
+
+def render_system_prompt(compiled, user_input: str) -> str:
+    if isinstance(compiled, SystemMessage):
+        return compiled.content
+    return compiled.format_messages(user_input=user_input)[0].content
+
+
+class PromptTemplateCache:
+    """LRU of compiled system prompts keyed by a hash of the prompt text, so the
+    (multi-kilobyte) patient prompt is parsed once per call and not on every turn"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.templates = OrderedDict()      # sha256 of prompt text -> compiled prompt
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prompt_text: str):
+        key = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+        with self.lock:
+            compiled = self.templates.get(key)
+            if compiled is not None:
+                self.templates.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = compile_system_prompt(prompt_text)
+        with self.lock:
+            self.templates[key] = compiled
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return compiled
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.templates), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+prompt_cache = PromptTemplateCache(max_size=int(os.getenv("PROMPT_CACHE_MAX_SIZE", "256")))
@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# Short utterances patients repeat a lot, by intent. Only the intents in the allowlist
+# are ever answered from the cache, the others depend on what the bot just said
+# (e.g. "yes" answers a question, "what?" asks to repeat the last reply).
+INTENT_PHRASES = {
+    "greeting": ["hello", "hi", "hey", "hello there", "hi there", "good morning", "good afternoon", "good evening", "hello elys", "hi elys", "are you there", "hello are you there"],
+    "identity": ["who are you", "what is your name", "whats your name", "who is this", "who am i talking to", "who is talking"],
+    # Not allowlisted by default, the reply usually refers to what was just talked about
+    "thanks": ["thank you", "thanks", "thank you very much", "thanks a lot", "thank you dear"],
+    "affirmation": ["yes", "yeah", "yep", "ok", "okay", "sure", "alright"],
+    "negation": ["no", "nope", "not really"],
+    "clarification": ["what", "pardon", "sorry", "what did you say", "say that again", "i didnt hear you", "can you repeat that"],
+}
+
+# Lowercase, no punctuation (apostrophes dropped so "what's" == "whats"), single spaces
+PUNCTUATION = re.compile(r"[^\w\s]")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_utterance(text: str) -> str:
+    text = PUNCTUATION.sub("", text.lower().replace("'", "").replace("’", ""))
+    return WHITESPACE.sub(" ", text).strip()
+
+
+def cosine_similarity(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class ResponseCache:
+    """Replies to short, repetitive patient utterances ("hello", "who are you?"), so
+    they don't need an LLM round trip every time.
+
+    - Only utterances of at most `max_words` words whose intent is in `intents` are cached.
+    - The intent is found by exact match of the normalized text against INTENT_PHRASES, or,
+      if an `embeddings` model is given, by the most similar phrase (>= `similarity_threshold`).
+    - Replies are scoped per patient prompt (a hash of the system prompt), so one
+      patient never gets a reply generated for another one. Only replies generated without
+      any conversation history are stored (see Langchain_service.is_first_turn).
+    - Entries expire after `ttl_seconds`, at most `max_entries` are kept (LRU).
+    """
+
+    def __init__(self, intents: set, ttl_seconds: float, max_entries: int, max_words: int = 6, embeddings=None, similarity_threshold: float = 0.9):
+        self.intents = intents
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_words = max_words
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+
+        self.phrase_intents = {phrase: intent for intent, phrases in INTENT_PHRASES.items() if intent in intents for phrase in phrases}
+        self.phrase_vectors = None          # [(vector, intent)], embedded on first use
+
+        self.entries = OrderedDict()        # (prompt hash, intent) -> (reply, stored at)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.hits_by_intent = {}
+
+    def is_candidate(self, text: str) -> Optional[str]:
+        """Normalized text if the utterance is short enough to be looked up, else None"""
+        normalized = normalize_utterance(text)
+        if not normalized or len(normalized.split()) > self.max_words:
+            return None
+        return normalized
+
+    def intent_of(self, text: str) -> Optional[str]:
+        """Allowlisted intent of the utterance or None if it isn't cacheable"""
+        normalized = self.is_candidate(text)
+        if normalized is None:
+            return self._skip()
+        intent = self.phrase_intents.get(normalized)
+        if intent is None and self.embeddings is not None:
+            try:
+                if self.phrase_vectors is None:
+                    self._set_phrase_vectors(self.embeddings.embed_documents(list(self.phrase_intents)))
+                intent = self._closest_intent(self.embeddings.embed_query(normalized))
+            except Exception as e:
+                logger.error(f"Error while embedding utterance for the response cache -> {str(e)}")
+        return intent if intent is not None else self._skip()
+
+    async def aintent_of(self, text: str) -> Optional[str]:
+        """Async version of intent_of"""
+        normalized = self.is_candidate(text)
+        if normalized is None:
+            return self._skip()
+        intent = self.phrase_intents.get(normalized)
+        if intent is None and self.embeddings is not None:
+            try:
+                if self.phrase_vectors is None:
+                    self._set_phrase_vectors(await self.embeddings.aembed_documents(list(self.phrase_intents)))
+                intent = self._closest_intent(await self.embeddings.aembed_query(normalized))
+            except Exception as e:
+                logger.error(f"Error while embedding utterance for the response cache -> {str(e)}")
+        return intent if intent is not None else self._skip()
+
+    def get(self, system_prompt: str, intent: Optional[str]) -> Optional[str]:
+        if intent is None:
+            return None
+        key = (self._scope(system_prompt), intent)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] >= self.ttl_seconds:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.hits_by_intent[intent] = self.hits_by_intent.get(intent, 0) + 1
+            return entry[0]
+
+    def put(self, system_prompt: str, intent: Optional[str], reply: str):
+        if intent is None or not reply:
+            return
+        key = (self._scope(system_prompt), intent)
+        with self.lock:
+            self.entries[key] = (reply, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "intents": sorted(self.intents),
+                "embeddings": self.embeddings is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "hits_by_intent": dict(self.hits_by_intent),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _skip(self):
+        with self.lock:
+            self.skipped += 1
+        return None
+
+    @staticmethod
+    def _scope(system_prompt: str) -> str:
+        return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+
+    def _set_phrase_vectors(self, vectors: list):
+        self.phrase_vectors = list(zip(vectors, self.phrase_intents.values()))
+
+    def _closest_intent(self, vector: list) -> Optional[str]:
+        best_intent, best_similarity = None, self.similarity_threshold
+        for phrase_vector, intent in self.phrase_vectors:
+            similarity = cosine_similarity(vector, phrase_vector)
+            if similarity >= best_similarity:
+                best_intent, best_similarity = intent, similarity
+        return best_intent
+
+
+def create_response_cache() -> ResponseCache:
+    """Embedding matching is used if RESPONSE_CACHE_EMBEDDINGS_MODEL is set, e.g.
+    "openai:text-embedding-3-small". RESPONSE_CACHE_INTENTS="" turns the cache off."""
+    embeddings = None
+    embeddings_model = os.getenv("RESPONSE_CACHE_EMBEDDINGS_MODEL")
+    if embeddings_model:
+        try:
+            from langchain.embeddings import init_embeddings
+            embeddings = init_embeddings(embeddings_model)
+        except Exception as e:
+            logger.error(f"Couldn't set up response cache embeddings {embeddings_model}, using exact matching -> {str(e)}")
+
+    intents = {intent.strip() for intent in os.getenv("RESPONSE_CACHE_INTENTS", "greeting,identity").split(",") if intent.strip()}
+    return ResponseCache(
+        intents=intents & set(INTENT_PHRASES),
+        ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "600")),
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        max_words=int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "6")),
+        embeddings=embeddings,
+        similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.9")),
+    )
+
+
+response_cache = create_response_cache()
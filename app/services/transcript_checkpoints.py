@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+# For saving the turns in the call's document
+from services.mongodb_service import checkpoint_call, stored_turn_count
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptCheckpointer:
+    """Saves the turns of a live call in Mongo while the call goes on, so a crash or a
+    redeploy doesn't lose the conversation.
+
+    `turn_added` is called after every turn (on the event loop). The new turns are written
+    once `every_turns` of them are waiting, or `every_seconds` after the first of them came.
+    Writes run in the background, one at a time: turns that come while a write is running
+    go out together in the next one. At the end of the call the post call job saves the
+    turns that weren't written yet (`unsaved_from` / `stored_turns`).
+
+    A reconnected call (same call id) continues after the turns already saved for it: the
+    turns `chat_history` starts with (restored from the conversation memory) aren't written
+    again, the new ones are added after the saved ones. If nothing was saved yet, all of
+    `chat_history` is.
+    """
+
+    def __init__(self, call_id, patient_id: str, carehome_id: str, chat_history: list, every_turns: int, every_seconds: float):
+        self.call_id = call_id
+        self.patient_id = patient_id
+        self.carehome_id = carehome_id
+        self.chat_history = chat_history
+        self.every_turns = every_turns
+        self.every_seconds = every_seconds
+        self.call_time = datetime.now(timezone.utc)
+
+        self.loop = asyncio.get_running_loop()
+        # Turns from before a reconnect, and how many turns the call's document already has
+        self.initial_turns = len(chat_history)
+        self.stored_base = None
+        self.stored_base_task = asyncio.create_task(stored_turn_count(call_id))
+        # New turns of this connection saved so far
+        self.flushed_turns = 0
+        self.timer = None
+        self.flush_task = None
+        self.flush_again = False
+        self.closed = False
+
+    @property
+    def unsaved_from(self) -> int:
+        """Index in chat_history of the first turn that isn't saved"""
+        return self.initial_turns + self.flushed_turns
+
+    @property
+    def stored_turns(self) -> int:
+        """Index in the saved conversation where that turn goes"""
+        return (self.stored_base or 0) + self.flushed_turns
+
+    def turn_added(self):
+        if self.closed:
+            return
+        if len(self.chat_history) - self.unsaved_from >= self.every_turns:
+            self.flush_soon()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.every_seconds, self.flush_soon)
+
+    def flush_soon(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_again = True
+            return
+        self.flush_task = asyncio.create_task(self._flush())
+
+    async def close(self) -> int:
+        """Stops checkpointing (waits for a write that is running, doesn't start one),
+        returns the number of turns saved in Mongo"""
+        if not self.closed:
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.flush_task is not None:
+                await asyncio.gather(self.flush_task, return_exceptions=True)
+            if self.stored_base is None and not await self._load_stored_base():
+                # Don't know what is saved: the post call job saves the whole chat_history
+                self.initial_turns = 0
+                self.flushed_turns = 0
+        return self.flushed_turns
+
+    async def _flush(self):
+        while True:
+            self.flush_again = False
+            await self._write()
+            if not self.flush_again:
+                return
+
+    async def _load_stored_base(self) -> bool:
+        try:
+            self.stored_base = await self.stored_base_task
+        except Exception as e:
+            logger.error(f"Error while reading saved transcript of call {self.call_id} -> {str(e)}")
+            # Read again on the next write
+            self.stored_base_task = asyncio.create_task(stored_turn_count(self.call_id))
+            return False
+        if self.stored_base == 0:
+            # Nothing saved (e.g. a crash before the first checkpoint), save the restored turns too
+            self.initial_turns = 0
+        return True
+
+    async def _write(self):
+        if self.stored_base is None and not await self._load_stored_base():
+            return
+        count = len(self.chat_history)
+        if count <= self.unsaved_from:
+            return
+        turns = self.chat_history[self.unsaved_from:count]
+        try:
+            await checkpoint_call(self.patient_id, self.call_id, self.carehome_id, self.call_time, turns, self.stored_turns)
+            self.flushed_turns = count - self.initial_turns
+        except Exception as e:
+            # The turns stay pending, the next write sends them again
+            logger.error(f"Error while checkpointing transcript of call {self.call_id} -> {str(e)}")
+
+
+def create_transcript_checkpointer(call_id, patient_id: str, carehome_id: str, chat_history: list):
+    """TRANSCRIPT_CHECKPOINT_TURNS=0 turns checkpointing off (returns None)"""
+    every_turns = int(os.getenv("TRANSCRIPT_CHECKPOINT_TURNS", "3"))
+    if every_turns <= 0:
+        return None
+    return TranscriptCheckpointer(
+        call_id,
+        patient_id,
+        carehome_id,
+        chat_history,
+        every_turns=every_turns,
+        every_seconds=float(os.getenv("TRANSCRIPT_CHECKPOINT_SECONDS", "20")),
+    )
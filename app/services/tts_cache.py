@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class TTSCache:
+    """Cache for synthesized audio, keyed by everything that changes the audio
+    (voice id, model, voice settings and the text itself).
+
+    - Memory tier: LRU, evicts least recently used audio once `max_bytes` is exceeded.
+    - Disk tier (optional, if `disk_dir` is given): survives restarts, evicts the
+      oldest files once `max_disk_bytes` is exceeded.
+
+    Used from the event loop and from worker threads, so everything is behind a lock.
+    On the event loop use `aget` / `aput`, they do the disk reads and writes in a worker thread.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()         # key -> audio bytes
+        self.memory_bytes = 0
+        self.disk_files = OrderedDict()     # key -> size, oldest first
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(voice_id: str, payload: dict) -> str:
+        """`payload` is the ElevenLabs request body (text, model_id, voice_settings...)"""
+        raw = json.dumps({"voice_id": voice_id, **payload}, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return audio
+
+        audio = self._read_disk(key)
+        with self.lock:
+            if audio is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._put_memory(key, audio)
+            return audio
+
+    def put(self, key: str, audio: bytes):
+        if not audio:
+            return
+        with self.lock:
+            self._put_memory(key, audio)
+        self._write_disk(key, audio)
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return audio
+        if not self.disk_dir:
+            with self.lock:
+                self.misses += 1
+            return None
+        return await asyncio.to_thread(self.get, key)
+
+    def aput(self, key: str, audio: bytes):
+        """Stores in memory right away, the disk write runs in a worker thread in the background"""
+        if not audio:
+            return
+        with self.lock:
+            self._put_memory(key, audio)
+        if self.disk_dir:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, audio)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.memory),
+                "bytes": self.memory_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_entries": len(self.disk_files),
+                "disk_bytes": self.disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _put_memory(self, key: str, audio: bytes):
+        # Caller holds the lock
+        if len(audio) > self.max_bytes:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old)
+        self.memory[key] = audio
+        self.memory_bytes += len(audio)
+        while self.memory_bytes > self.max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.mp3")
+
+    def _load_disk_index(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith(".mp3"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk_files[key] = size
+            self.disk_bytes += size
+        logger.info(f"TTS disk cache loaded {len(self.disk_files)} files from {self.disk_dir}")
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        with self.lock:
+            if key not in self.disk_files:
+                return None
+        try:
+            with open(self._path(key), "rb") as audio_file:
+                return audio_file.read()
+        except OSError:
+            with self.lock:
+                self.disk_bytes -= self.disk_files.pop(key, 0)
+            return None
+
+    def _write_disk(self, key: str, audio: bytes):
+        if not self.disk_dir:
+            return
+        with self.lock:
+            if key in self.disk_files:
+                return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file first so a crash never leaves half a file behind
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as audio_file:
+                audio_file.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error while writing TTS cache file {path} -> {str(e)}")
+            return
+
+        evict = []
+        with self.lock:
+            # Another write of the same key may have finished first, it replaced the same file
+            if key in self.disk_files:
+                return
+            self.disk_files[key] = len(audio)
+            self.disk_bytes += len(audio)
+            while self.max_disk_bytes and self.disk_bytes > self.max_disk_bytes and len(self.disk_files) > 1:
+                old_key, size = self.disk_files.popitem(last=False)
+                self.disk_bytes -= size
+                evict.append(old_key)
+        for old_key in evict:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+
+# 32 MB in memory by default, disk tier only if TTS_CACHE_DIR is set
+tts_cache = TTSCache(
+    max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    disk_dir=os.getenv("TTS_CACHE_DIR"),
+    max_disk_bytes=int(os.getenv("TTS_CACHE_MAX_DISK_BYTES", str(512 * 1024 * 1024))),
+)
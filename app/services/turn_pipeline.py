@@ -0,0 +1,263 @@
+import asyncio
+import base64
+import json
+import logging
+
+from services.Langchain_service import ainvoke_model, astream_model, atrim_interrupted_reply
+
+# For TTS (text to speech)
+from utils.eleven_labs_utils import atext_to_speech_bytes, FALLBACK_TEXT
+
+# For binary audio frames
+from utils.audio_frames import encode_audio_frame, AUDIO_FRAME_HEADER, AUDIO_FRAME_VERSION
+
+# for sending intruptions
+from utils.utils import send_interruption
+
+# For cutting the streamed LLM reply into speakable pieces
+from utils.sentence_chunker import SentenceChunker
+
+
+logger = logging.getLogger(__name__)
+
+
+class TurnPipeline:
+    """Processes the user's finished sentences for one call on the event loop.
+
+    Deepgram calls our transcript handler on its own receive thread. That thread
+    should only hand the sentence over (`submit`) and go back to delivering transcripts,
+    the LLM and TTS work for the turn is then awaited here on the event loop.
+
+    With `streaming` on, the LLM reply is streamed, cut into sentences/clauses and every
+    piece is synthesized and sent as soon as it is ready with "complete": false, the
+    last piece of the reply is sent with "complete": true. A piece whose TTS fails is skipped,
+    the fallback ("Oh sorry can you repeat?") is only played if no piece of the reply could be.
+
+    Barge-in: as soon as the user starts talking (`on_speech`) the turn that is being
+    generated is cancelled and everything already queued for it is dropped. Every
+    message in `message_queue` is a (turn_id, message) tuple so the sender can skip
+    stale ones with `is_stale`, turn_id None is used for control messages. The part of the
+    reply that wasn't played is dropped from the chat memory too (`trim_reply`).
+
+    With `binary` on, audio goes out as raw binary websocket frames (see utils/audio_frames.py)
+    instead of base64 inside JSON, control messages stay JSON text frames.
+
+    `on_turn` (optional) is called on the event loop after every turn is added to `chat_history`.
+    """
+
+    def __init__(self, websocket, message_queue: asyncio.Queue, chat_id, prompt: str, voice_id: str, chat_history: list = None, streaming: bool = False, binary: bool = False, on_turn=None):
+        self.websocket = websocket
+        self.message_queue = message_queue
+        self.chat_id = chat_id
+        self.prompt = prompt
+        self.voice_id = voice_id
+        self.chat_history = chat_history
+        self.streaming = streaming
+        self.binary = binary
+        self.on_turn = on_turn
+
+        self.loop = asyncio.get_running_loop()
+        self.transcripts = asyncio.Queue()
+        self.task = None
+
+        # Turn 0 is the greeting, every new user utterance moves to the next turn
+        self.turn_id = 0
+        self.turn_task = None
+        # Removes the unsaid part of an interrupted reply from the chat memory, the next turn waits for it
+        self.trim_task = None
+        self.user_speaking = False
+        self.background_tasks = set()
+
+        # Sequence number of the next audio frame of `sequence_turn_id`
+        self.sequence_turn_id = 0
+        self.next_sequence = 0
+
+    def submit(self, sentence: str):
+        """Thread-safe, called from the Deepgram callback thread"""
+        self.loop.call_soon_threadsafe(self.transcripts.put_nowait, sentence)
+
+    def on_speech(self):
+        """Thread-safe, called from the Deepgram callback thread when the user starts talking"""
+        self.loop.call_soon_threadsafe(self.barge_in)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.turn_task is not None:
+            self.turn_task.cancel()
+
+    async def aclose(self):
+        """stop() and wait until the turn in flight has saved what it said, so chat_history is final"""
+        self.stop()
+        tasks = [task for task in (self.task, self.turn_task, self.trim_task) if task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def is_stale(self, turn_id) -> bool:
+        return turn_id is not None and turn_id != self.turn_id
+
+    def barge_in(self):
+        """Cancel the turn in flight and drop its queued audio, once per user utterance"""
+        if self.user_speaking:
+            return
+        self.user_speaking = True
+
+        # Everything queued with an older turn id is now skipped by the sender
+        self.turn_id += 1
+        if self.turn_task is not None and not self.turn_task.done():
+            logger.info("User barged in, cancelling the current turn")
+            self.turn_task.cancel()
+
+        task = asyncio.create_task(send_interruption(self.websocket))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def run(self):
+        while True:
+            sentence = await self.transcripts.get()
+            # If no interim transcript came before this one, barge in now
+            self.barge_in()
+            self.user_speaking = False
+            self.turn_task = asyncio.create_task(self.run_turn(self.turn_id, sentence))
+
+    async def run_turn(self, turn_id: int, sentence: str):
+        try:
+            if self.trim_task is not None:
+                await asyncio.gather(self.trim_task, return_exceptions=True)
+            if self.streaming:
+                await self.process_turn_streaming(turn_id, sentence)
+            else:
+                await self.process_turn(turn_id, sentence)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception(f"Error while processing turn in turn_pipeline.py -> {str(e)}")
+
+    async def process_turn(self, turn_id: int, sentence: str):
+        llm_response = ""
+        try:
+            llm_response = await ainvoke_model(sentence, self.chat_id, self.prompt)
+            audio = await atext_to_speech_bytes(llm_response, self.voice_id)
+            self.send_audio(audio, True, turn_id)
+        except asyncio.CancelledError:
+            # Interrupted before the reply was sent, nothing of it was said
+            self.trim_reply(sentence, "")
+            raise
+        except Exception:
+            self.save_turn(sentence, llm_response)
+            raise
+        self.save_turn(sentence, llm_response)
+
+    async def process_turn_streaming(self, turn_id: int, sentence: str):
+        chunker = SentenceChunker()
+        reply = []
+        tts_tasks = []          # one TTS task per chunk, in the order of the reply
+        chunk_texts = []        # text of every chunk, same order
+        played = []             # text of the chunks whose audio was sent
+        changed = asyncio.Event()
+        llm_done = False
+
+        def synthesize(chunk):
+            chunk_texts.append(chunk)
+            tts_tasks.append(asyncio.create_task(atext_to_speech_bytes(chunk, self.voice_id, fallback=False)))
+            changed.set()
+
+        async def read_llm():
+            nonlocal llm_done
+            try:
+                async for token in astream_model(sentence, self.chat_id, self.prompt):
+                    reply.append(token)
+                    for chunk in chunker.feed(token):
+                        synthesize(chunk)
+                for chunk in chunker.flush():
+                    synthesize(chunk)
+            finally:
+                llm_done = True
+                changed.set()
+
+        llm_task = asyncio.create_task(read_llm())
+        sent = 0
+        sent_complete = False
+        cancelled = False
+        try:
+            while True:
+                if sent < len(tts_tasks):
+                    index = sent
+                    sent += 1
+                    try:
+                        audio = await tts_tasks[index]
+                    except Exception as e:
+                        logger.error(f"Skipping a piece of the reply, its TTS failed -> {str(e)}")
+                        continue
+                    played.append(chunk_texts[index])
+                    # Only known to be the last piece if the LLM is already done
+                    sent_complete = llm_done and sent == len(tts_tasks)
+                    self.send_audio(audio, sent_complete, turn_id)
+                elif llm_done:
+                    break
+                else:
+                    changed.clear()
+                    await changed.wait()
+
+            if tts_tasks and not played:
+                # None of the reply could be synthesized
+                self.send_audio(await atext_to_speech_bytes(FALLBACK_TEXT, self.voice_id, fallback=False), True, turn_id)
+                sent_complete = True
+
+            # Raise LLM errors (if any)
+            await llm_task
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            llm_task.cancel()
+            for task in tts_tasks:
+                task.cancel()
+            if not sent_complete:
+                # The LLM finished after the last piece was sent, close the reply.
+                # If the turn was interrupted this gets dropped by the sender anyway
+                self.send_audio(b"", True, turn_id)
+            if not cancelled:
+                self.save_turn(sentence, "".join(reply))
+            else:
+                # Interrupted (barge-in): keep only the part of the reply that was sent
+                said = " ".join(chunk.strip() for chunk in played)
+                if played:
+                    self.save_turn(sentence, said)
+                self.trim_reply(sentence, said)
+
+    def trim_reply(self, sentence: str, said: str):
+        self.trim_task = asyncio.create_task(atrim_interrupted_reply(self.chat_id, sentence, said))
+
+    def save_turn(self, sentence: str, llm_response: str):
+        if self.chat_history is not None:
+            self.chat_history.append({"user_query": sentence, "bot": llm_response})
+            if self.on_turn is not None:
+                self.on_turn()
+
+    def audio_format_message(self) -> str:
+        """Confirms to the frontend that binary audio frames were accepted for this call"""
+        return json.dumps({
+            "type": "audio_format",
+            "format": "binary",
+            "version": AUDIO_FRAME_VERSION,
+            "header_size": AUDIO_FRAME_HEADER.size,
+        })
+
+    def send_audio(self, audio: bytes, complete: bool, turn_id: int = None):
+        if turn_id is None:
+            turn_id = self.turn_id
+
+        if self.binary:
+            if turn_id != self.sequence_turn_id:
+                self.sequence_turn_id = turn_id
+                self.next_sequence = 0
+            message = encode_audio_frame(turn_id, self.next_sequence, audio, complete)
+            self.next_sequence += 1
+        else:
+            # Send audio as base64 string in JSON
+            message = json.dumps({"audio": base64.b64encode(audio).decode('utf-8'), "complete": complete})
+        self.message_queue.put_nowait((turn_id, message))
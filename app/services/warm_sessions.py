@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from services.Langchain_service import greet_user
+from services.preparing_prompt import prepare_prompt_from_context
+
+# For loading the patient context without blocking the event loop
+from services.postgres import aget_cached_patient_context
+
+# For TTS (text to speech)
+from utils.eleven_labs_utils import atext_to_speech_bytes
+
+# For session tokens
+from utils.utils import generate_uuid
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class WarmSession:
+    """Everything call_with_bot needs before the patient can hear the bot"""
+
+    def __init__(self, patient_id: str, prompt: str, greeting: str, greeting_audio: bytes, schedule_id: str = None):
+        self.patient_id = patient_id
+        # Scheduled call this session is for, marked completed after the call
+        self.schedule_id = schedule_id
+        self.prompt = prompt
+        self.greeting = greeting
+        self.greeting_audio = greeting_audio
+
+
+async def warm_up_call(patient_id: str, patient_name: str, voice_id: str, context=None, schedule_id: str = None) -> WarmSession:
+    """Builds the prompt (from `context` if the PatientContext was already loaded),
+    generates the greeting and synthesizes its audio"""
+    if context is None:
+        context = await aget_cached_patient_context(patient_id)
+    prompt = prepare_prompt_from_context(context)
+    greetings = await greet_user(patient_name)
+    audio = await atext_to_speech_bytes(greetings.content, voice_id)
+    if schedule_id is None and context is not None:
+        schedule_id = context.schedule_id
+    return WarmSession(patient_id, prompt, greetings.content, audio, schedule_id)
+
+
+class WarmSessionStore:
+    """Warm sessions started by /get-data-before-call, claimed by the websocket with
+    their token. A session nobody claims is dropped after `ttl_seconds`.
+
+    Sessions live in this worker's memory, if the websocket lands on another worker
+    the claim simply misses and the call is prepared the normal way.
+    """
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.sessions = {}      # token -> (patient_id, warm up task)
+
+    def start(self, patient_id: str, patient_name: str, voice_id: str, context=None, schedule_id: str = None) -> str:
+        """Starts warming up in the background, returns the token to claim it with.
+        Has to be called from the event loop."""
+        token = generate_uuid()
+        task = asyncio.create_task(warm_up_call(patient_id, patient_name, voice_id, context, schedule_id))
+        task.add_done_callback(self._log_failure)
+        self.sessions[token] = (patient_id, task)
+        asyncio.get_running_loop().call_later(self.ttl_seconds, self.expire, token)
+        return token
+
+    async def claim(self, token: str, patient_id: str, timeout: float = 15):
+        """Returns the WarmSession for the token (waits if it is still warming up),
+        None if there is no usable session and the call has to be prepared normally"""
+        entry = self.sessions.pop(token, None)
+        if entry is None:
+            return None
+        session_patient_id, task = entry
+        if session_patient_id != patient_id:
+            logger.warning("Warm session claimed for a different patient, ignoring it")
+            task.cancel()
+            return None
+        try:
+            return await asyncio.wait_for(task, timeout)
+        except Exception as e:
+            logger.error(f"Warm session couldn't be used -> {str(e)}")
+            return None
+
+    def expire(self, token: str):
+        entry = self.sessions.pop(token, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error while warming up call session -> {str(task.exception())}")
+
+
+warm_sessions = WarmSessionStore(ttl_seconds=int(os.getenv("WARM_SESSION_TTL", "120")))
@@ -0,0 +1,27 @@
+import struct
+
+
+# Header in front of every binary audio frame (network byte order):
+#   version  (1 byte)   -> AUDIO_FRAME_VERSION
+#   flags    (1 byte)   -> bit 0 set on the last frame of the turn
+#   turn_id  (4 bytes)  -> turn the audio belongs to (0 is the greeting)
+#   sequence (4 bytes)  -> position of the frame inside its turn, starting at 0
+AUDIO_FRAME_HEADER = struct.Struct("!BBII")
+AUDIO_FRAME_VERSION = 1
+FLAG_FINAL = 0x01
+
+
+def encode_audio_frame(turn_id: int, sequence: int, audio: bytes, final: bool) -> bytes:
+    """Puts the header in front of the raw MP3 bytes"""
+    flags = FLAG_FINAL if final else 0
+    return AUDIO_FRAME_HEADER.pack(AUDIO_FRAME_VERSION, flags, turn_id, sequence) + audio
+
+
+def decode_audio_frame(frame: bytes):
+    """Opposite of encode_audio_frame
+    OUTPUT:
+        - turn_id, sequence, audio (bytes), final (bool)"""
+    version, flags, turn_id, sequence = AUDIO_FRAME_HEADER.unpack_from(frame)
+    if version != AUDIO_FRAME_VERSION:
+        raise ValueError(f"Unknown audio frame version: {version}")
+    return turn_id, sequence, frame[AUDIO_FRAME_HEADER.size:], bool(flags & FLAG_FINAL)
@@ -1,18 +1,46 @@
-from services.eleven_lab_services import ElevenLabsService
+from services.eleven_lab_services import ElevenLabsService, AsyncElevenLabsService
 import base64
+import logging
 
-def text_to_speech(text: str, voice_id: str) -> bytes:
-    """Convert text to speech using ElevenLabs API with latency optimization"""
+logger = logging.getLogger(__name__)
+
+FALLBACK_TEXT = "Oh sorry can you repeat?"
+
+
+def text_to_speech_bytes(text: str, voice_id: str, fallback: bool = True) -> bytes:
+    """Convert text to speech using ElevenLabs API with latency optimization, returns raw MP3 bytes"""
     try:
-        audio_data = ElevenLabsService.text_to_speech(
+        return ElevenLabsService.text_to_speech(
             text=text, 
             voice_id= voice_id, 
             optimize_streaming_latency=4
         )
+    except Exception as e:
+        logger.error(f"Error in text_to_speech for text '{text}' -> {str(e)}")
+        if not fallback:
+            raise
+        return text_to_speech_bytes(FALLBACK_TEXT, voice_id, fallback=False)
+
 
-        # Encode audio bytes to base64 string
-        audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-        return audio_base64
-    
+async def atext_to_speech_bytes(text: str, voice_id: str, fallback: bool = True) -> bytes:
+    """Async version of text_to_speech_bytes, uses the pooled ElevenLabs client"""
+    try:
+        return await AsyncElevenLabsService.text_to_speech(
+            text=text,
+            voice_id=voice_id,
+            optimize_streaming_latency=4
+        )
     except Exception as e:
-        return text_to_speech("Oh sorry can you repeat?")
+        logger.error(f"Error in atext_to_speech_bytes for text '{text}' -> {str(e)}")
+        if not fallback:
+            raise
+        return await atext_to_speech_bytes(FALLBACK_TEXT, voice_id, fallback=False)
+
+
+def text_to_speech(text: str, voice_id: str) -> str:
+    """Same as text_to_speech_bytes but the audio is encoded as a base64 string (for JSON messages)"""
+    audio_data = text_to_speech_bytes(text, voice_id)
+
+    # Encode audio bytes to base64 string
+    audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+    return audio_base64
@@ -0,0 +1,56 @@
+import re
+
+
+# Sentence end: . ! ? (with closing quotes/brackets) followed by a space
+SENTENCE_END = re.compile(r'[.!?]+["\')\]]*(?=\s)')
+
+# Clause end: , ; : or a dash followed by a space
+CLAUSE_END = re.compile(r'(?:[,;:]|\s[-–—])(?=\s)')
+
+# Words that end with a '.' but don't end the sentence
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "jr", "sr", "prof", "e.g", "i.e", "etc"}
+
+
+class SentenceChunker:
+    """Collects LLM tokens while they are streamed and hands back pieces of text
+    that are ready to be spoken (full sentences, or clauses if a sentence gets long).
+
+    INPUT:
+        - clause_chars: once this many characters are waiting without a sentence end,
+          the text is cut at the last clause boundary instead
+    """
+
+    def __init__(self, clause_chars: int = 60):
+        self.clause_chars = clause_chars
+        self.buffer = ""
+
+    def feed(self, token: str) -> list:
+        """Add a token, returns the chunks (if any) that got completed by it"""
+        self.buffer += token
+        chunks = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def flush(self) -> list:
+        """Returns whatever is left once the LLM has finished"""
+        chunk, self.buffer = self.buffer.strip(), ""
+        return [chunk] if chunk else []
+
+    def _find_cut(self):
+        for match in SENTENCE_END.finditer(self.buffer):
+            words = self.buffer[:match.start()].split()
+            if words and words[-1].lower() in ABBREVIATIONS:
+                continue
+            return match.end()
+
+        if len(self.buffer) >= self.clause_chars:
+            cuts = [match.end() for match in CLAUSE_END.finditer(self.buffer)]
+            if cuts:
+                return cuts[-1]
+        return None
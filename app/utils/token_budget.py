@@ -0,0 +1,63 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+
+# Every chat message costs a few tokens on top of its content (role, separators)
+TOKENS_PER_MESSAGE = 4
+
+# Rough size of a token, only used if the tiktoken encoding can't be loaded
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str = "gpt-3.5-turbo"):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Not an OpenAI model (groq, anthropic...), close enough for budgeting
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads the encoding on first use, don't fail the call if it can't
+        logger.error(f"Couldn't load tiktoken encoding, estimating tokens from length -> {str(e)}")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message, model_name: str = "gpt-3.5-turbo") -> int:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return TOKENS_PER_MESSAGE + count_text_tokens(content, model_name)
+
+
+def select_history(system_prompt: str, messages: list, budget: int, model_name: str = "gpt-3.5-turbo") -> list:
+    """Picks the most recent messages that fit in `budget` tokens together with the system prompt.
+    The system prompt is always sent and so is the latest message, even if they go over the budget.
+
+    INPUT:
+        - system_prompt: the patient prompt (pinned, counted first)
+        - messages: conversation turns, oldest first
+        - budget: max prompt tokens for system prompt + history
+    OUTPUT:
+        - list of the messages to send, oldest first
+    """
+    remaining = budget - TOKENS_PER_MESSAGE - count_text_tokens(system_prompt, model_name)
+    selected = []
+    for message in reversed(messages):
+        tokens = count_message_tokens(message, model_name)
+        if selected and tokens > remaining:
+            break
+        selected.append(message)
+        remaining -= tokens
+    selected.reverse()
+    return selected